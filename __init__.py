@@ -1,32 +1,57 @@
-import bpy
-from bpy.props import PointerProperty
-
-from . spectrumexportproperties import SpectrumExportProperties
-from . spectrumexport import SpectrumExport
-from . spectrumexportpanel import SpectrumExportPanel
-
-# Configuration Values
-
-bl_info = {
-    "name": "Audio Visualization Tools",
-    "blender": (3, 2, 1),
-    "category": "Sound",
-    }
-
-
-def register():
-    bpy.utils.register_class(SpectrumExport)
-    bpy.utils.register_class(SpectrumExportPanel)
-    bpy.utils.register_class(SpectrumExportProperties)
-    bpy.types.Scene.spectrum_export_props = PointerProperty(type=SpectrumExportProperties)
-
-
-def unregister():
-    bpy.types.Scene.spectrum_export_props = None
-    bpy.utils.unregister_class(SpectrumExport)
-    bpy.utils.unregister_class(SpectrumExportPanel)
-    bpy.utils.unregister_class(SpectrumExportProperties)
-
-
-if __name__ == "__main__":
-    register()
+try:
+    import bpy
+except ImportError:
+    # Imported outside of blender, e.g. by the command line interface.
+    # Only the modules without blender dependencies can be used then.
+    bpy = None
+
+# Configuration Values
+
+bl_info = {
+    "name": "Audio Visualization Tools",
+    "blender": (3, 2, 1),
+    "category": "Sound",
+    }
+
+if bpy is not None:
+    from bpy.props import PointerProperty
+
+    from . spectrumexportproperties import SpectrumExportPreset, SpectrumExportProperties
+    from . spectrumexport import SpectrumClearCache, SpectrumExport, SpectrumFeatureExport, SpectrumPresetAdd, \
+        SpectrumPresetRemove
+    from . spectrumexportpanel import SpectrumExportPanel
+    from . spectrumnodes import SpectrumAtlasNodes
+    from . spectrumpreview import SpectrumPreviewToggle, stop_preview
+
+
+def register():
+    bpy.utils.register_class(SpectrumExport)
+    bpy.utils.register_class(SpectrumClearCache)
+    bpy.utils.register_class(SpectrumFeatureExport)
+    bpy.utils.register_class(SpectrumExportPanel)
+    bpy.utils.register_class(SpectrumAtlasNodes)
+    bpy.utils.register_class(SpectrumPreviewToggle)
+    bpy.utils.register_class(SpectrumPresetAdd)
+    bpy.utils.register_class(SpectrumPresetRemove)
+    bpy.utils.register_class(SpectrumExportPreset)
+    bpy.utils.register_class(SpectrumExportProperties)
+    bpy.types.Scene.spectrum_export_props = PointerProperty(type=SpectrumExportProperties)
+
+
+def unregister():
+    stop_preview()
+    bpy.types.Scene.spectrum_export_props = None
+    bpy.utils.unregister_class(SpectrumExport)
+    bpy.utils.unregister_class(SpectrumClearCache)
+    bpy.utils.unregister_class(SpectrumFeatureExport)
+    bpy.utils.unregister_class(SpectrumExportPanel)
+    bpy.utils.unregister_class(SpectrumAtlasNodes)
+    bpy.utils.unregister_class(SpectrumPreviewToggle)
+    bpy.utils.unregister_class(SpectrumPresetAdd)
+    bpy.utils.unregister_class(SpectrumPresetRemove)
+    bpy.utils.unregister_class(SpectrumExportProperties)
+    bpy.utils.unregister_class(SpectrumExportPreset)
+
+
+if __name__ == "__main__":
+    register()
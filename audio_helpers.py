@@ -1,10 +1,18 @@
 """
 File containing useful functions for audio analyzation.
 """
+import functools
+
 import numpy as np
 
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    # Blender does not ship scipy, numpy is used instead
+    scipy_fft = None
+
 
-def collect_samples_safe(arr, center: int, width: int, dtype=np.float32):
+def collect_samples_safe(arr, center: int, width: int, dtype=np.float32, out=None):
     """
     Collects samples around the center. Values outside the array will be
     filled with 0.
@@ -14,24 +22,127 @@ def collect_samples_safe(arr, center: int, width: int, dtype=np.float32):
         center (int) The center of the window for the selection.
         width (int) The width of the window.
         dtype (type, optional) The valuetype in the output.
+        out (np.ndarray, optional) Buffer of length width the samples are
+            written to. If given no new array is allocated and dtype is ignored.
     Returns:
         A 1d numpy array with the collected values.
     """
     if arr.ndim != 1:
         raise ValueError("Array is not 1D")
 
-    buffer = np.zeros(width, dtype=dtype)
+    if out is None:
+        buffer = np.empty(width, dtype=dtype)
+    else:
+        if out.shape != (width,):
+            raise ValueError("Output buffer does not match the width")
+        buffer = out
+
+    # Range of the array that is covered by the window
+    start = center - width//2
+    lo = min(max(start, 0), len(arr))
+    hi = min(max(start + width, 0), len(arr))
 
-    for i in range(width):
-        sel = i - width//2 + center
-        if sel < 0:
-            continue
-        if sel >= len(arr):
-            break
-        buffer[i] = arr[sel]
+    # Copy the covered part and fill the borders with zeros
+    n_left = min(max(lo - start, 0), width)
+    buffer[:n_left] = 0
+    buffer[n_left:n_left + hi - lo] = arr[lo:hi]
+    buffer[n_left + hi - lo:] = 0
     return buffer
 
 
+def _cosine_sum(length: int, coefficients):
+    """
+    Calculates a symmetric cosine sum window like Hann or Blackman-Harris.
+    """
+    if length == 1:
+        return np.ones(1)
+    terms = 2*np.pi*np.arange(length)/(length - 1)
+    window = np.zeros(length)
+    for k, a in enumerate(coefficients):
+        window += (-1)**k * a * np.cos(k*terms)
+    return window
+
+
+WINDOW_FUNCTIONS = {
+    "BLACKMAN_HARRIS": lambda n: _cosine_sum(n, (0.35875, 0.48829, 0.14128, 0.001168)),
+    "HANN": lambda n: _cosine_sum(n, (0.5, 0.5)),
+    "HAMMING": lambda n: _cosine_sum(n, (0.54, 0.46)),
+    "FLAT_TOP": lambda n: _cosine_sum(n, (0.21557895, 0.41663158, 0.277263158,
+                                          0.083578947, 0.006947368)),
+    "KAISER": lambda n: np.kaiser(n, 8.6),
+}
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_curve(func, length: int, dtype, args):
+    """
+    Evaluates and memoizes a curve. The least recently used curves will be
+    evicted. The returned arrays are read only as they are shared.
+    """
+    curve = np.asarray(func(length, *args), dtype=dtype)
+    curve.flags.writeable = False
+    return curve
+
+
+def get_window(window_type: str, length: int, dtype=np.float32):
+    """
+    Returns the window of the given type. Windows are cached by type, length
+    and dtype.
+
+    Args:
+        window_type (str) Key of the window in WINDOW_FUNCTIONS.
+        length (int) The length of the window.
+        dtype (type, optional) The valuetype of the window.
+    Returns:
+        A read only 1d numpy array with the window.
+    """
+    if window_type not in WINDOW_FUNCTIONS:
+        raise ValueError(f"Unknown window type {window_type}")
+    return _cached_curve(WINDOW_FUNCTIONS[window_type], length, np.dtype(dtype), ())
+
+
+def _boost_curve(length: int, gain_per_octave: float, nyquist: float):
+    # b = db/octave
+    # a = gain = 10^(b/20)
+    # f = a^(log2(x)); x = frequency
+    return gain_per_octave**np.log2(np.linspace(0, nyquist, num=length)+1)
+
+
+def get_boost_curve(gain_per_octave: float, length: int, nyquist: float, dtype=np.float32):
+    """
+    Returns the cached gain curve for a boost per octave over the
+    frequency bins 0 to nyquist.
+
+    Args:
+        gain_per_octave (float) The linear gain applied per octave.
+        length (int) The number of frequency bins.
+        nyquist (float) The frequency of the last bin.
+        dtype (type, optional) The valuetype of the curve.
+    Returns:
+        A read only 1d numpy array with the gain of each bin.
+    """
+    return _cached_curve(_boost_curve, length, np.dtype(dtype), (gain_per_octave, nyquist))
+
+
+def _rolloff_curve(length: int):
+    # Rolloff is an upside down parabola -(x-1)^2+1
+    # Quadratic looks better than linear
+    return 1 - (np.linspace(-1, 0, num=length)**2)
+
+
+def get_rolloff_curve(length: int, dtype=np.float32):
+    """
+    Returns the cached bass rolloff curve.
+
+    Args:
+        length (int) The number of values the rolloff spans.
+        dtype (type, optional) The valuetype of the curve.
+    Returns:
+        A read only 1d numpy array rising from 0 to 1.
+    """
+    return _cached_curve(_rolloff_curve, length, np.dtype(dtype), ())
+
+
 def blackman_harris_window(samples):
     """
     Applies a Blackman-Harris over the Samples.
@@ -40,10 +151,479 @@ def blackman_harris_window(samples):
     Args:
         samples(np.ndarry) The samples that should be windowed.
     """
-    alpha = np.array([-0.48829, 0.14128, -0.001168])
-    terms = np.pi*np.arange(len(samples))/(len(samples) - 1)
+    samples *= get_window("BLACKMAN_HARRIS", len(samples), samples.dtype)
+
+
+def frame_centers(n_frames: int, fps: float, samplerate: int):
+    """
+    Calculates the sample index at the center of each output frame.
+
+    Args:
+        n_frames (int) The number of output frames.
+        fps (float) The framerate of the output.
+        samplerate (int) The samplerate of the audio.
+    Returns:
+        A 1d numpy array with the center index of every frame.
+    """
+    return (np.arange(n_frames) * (1/fps) * samplerate).astype(np.int64)
+
+
+# Part of the decimated Nyquist frequency up to which the signal is kept,
+# above it the transition band of the decimation filter starts
+DECIMATION_PASSBAND = 0.8
+
+# Stopband attenuation of the decimation filter in dB
+DECIMATION_ATTENUATION = 80
+
+
+def decimation_factor(samplerate: int, max_freq: float):
+    """
+    Returns the largest integer factor the samplerate can be divided by,
+    so that max_freq still lies in the passband of the decimation filter.
+    """
+    return max(int(DECIMATION_PASSBAND*samplerate/(2*max_freq)), 1)
+
+
+def decimation_filter(factor: int):
+    """
+    Designs the anti-aliasing lowpass of a decimation as Kaiser windowed
+    sinc. The cutoff is the decimated Nyquist frequency. The transition
+    band reaches as far above as the passband ends below it, so all
+    aliases fold back above the passband.
+
+    Args:
+        factor (int) The decimation factor.
+    Returns:
+        The symmetric float32 filter taps with a DC gain of 1, an odd number.
+    """
+    cutoff = 0.5/factor
+    width = 2*(1 - DECIMATION_PASSBAND)*cutoff
+    # Kaiser's estimate of the length and shape for the attenuation
+    n_taps = int(np.ceil((DECIMATION_ATTENUATION - 8)/(2.285*2*np.pi*width))) + 1
+    n_taps += 1 - n_taps % 2
+    beta = 0.1102*(DECIMATION_ATTENUATION - 8.7)
+
+    n = np.arange(n_taps) - (n_taps - 1)/2
+    taps = 2*cutoff*np.sinc(2*cutoff*n)*np.kaiser(n_taps, beta)
+    return (taps/np.sum(taps)).astype(np.float32)
+
+
+def decimate_windows(block, starts, length: int, taps, factor: int):
+    """
+    Lowpass filters and decimates a block of samples with a polyphase
+    filter and returns windows of the decimated samples. Only every
+    factor-th output of the filter is calculated: the samples are split
+    into the phases, which are multiplied with their part of the taps.
+
+    Args:
+        block (np.ndarray) The samples at the original rate, the channels
+            are on the first axes. Decimated sample m is the filter output
+            centered on sample m*factor + len(taps)//2 of the block.
+        starts (np.ndarray) The first decimated sample of every window.
+        length (int) The decimated samples per window.
+        taps (np.ndarray) The filter created by decimation_filter.
+        factor (int) The decimation factor.
+    Returns:
+        An array of shape (..., windows, length).
+    """
+    n_out = int(starts[-1]) + length
+    n_phase_taps = -(-len(taps)//factor)
+    phase_taps = np.zeros(n_phase_taps*factor, dtype=np.float32)
+    phase_taps[:len(taps)] = taps
+    phase_taps = phase_taps.reshape(n_phase_taps, factor)
+
+    # Row r holds the samples r*factor to r*factor + factor - 1
+    samples = np.zeros(block.shape[:-1] + ((n_out + n_phase_taps)*factor,), dtype=np.float32)
+    n = min(block.shape[-1], samples.shape[-1])
+    samples[..., :n] = block[..., :n]
+    samples = samples.reshape(block.shape[:-1] + (-1, factor))
+
+    decimated = np.zeros(block.shape[:-1] + (n_out,), dtype=np.float32)
+    for q in range(n_phase_taps):
+        decimated += samples[..., q:q + n_out, :] @ phase_taps[q]
+    view = np.lib.stride_tricks.sliding_window_view(decimated, length, axis=-1)
+    return view[..., starts, :]
+
+
+def next_fast_len(n: int):
+    """
+    Returns the smallest length of at least n that only has the prime
+    factors 2, 3 and 5, for which the FFT is fast.
+    """
+    if scipy_fft is not None:
+        return scipy_fft.next_fast_len(n, real=True)
+    best = 1 << max(int(n - 1).bit_length(), 0)
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            # Smallest power of two that reaches n
+            length = power35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+def rfft(frames, n_fft: int, workers: int = 1):
+    """
+    Real FFT along the last axis that keeps single precision, float32
+    frames give complex64 spectra. Uses scipy.fft if it is installed.
+
+    Args:
+        frames (np.ndarray) Array with one frame of samples along the last
+            axis, may be overwritten.
+        n_fft (int) The FFT size.
+        workers (int, optional) Threads of scipy.fft for one call.
+    Returns:
+        The complex spectra.
+    """
+    if scipy_fft is not None:
+        return scipy_fft.rfft(frames, n_fft, axis=-1, workers=workers, overwrite_x=True)
+    spectra = np.fft.rfft(frames, n_fft, axis=-1)
+    if frames.dtype == np.float32:
+        # numpy before 2.0 always transforms in double precision
+        spectra = spectra.astype(np.complex64, copy=False)
+    return spectra
+
+
+def windowed_rfft(frames, n_fft: int, window, workers: int = 1):
+    """
+    Applies the window to a matrix of frames in place and transforms all
+    rows with a single batched FFT.
+
+    Args:
+        frames (np.ndarray) Array with one frame of samples along the last
+            axis, e.g. (frames, samples) or (frames, channels, samples).
+        n_fft (int) The FFT size, window_size plus the zero extension.
+        window (np.ndarray) The window applied before the transform.
+        workers (int, optional) Threads of scipy.fft for one call.
+    Returns:
+        A complex array with one spectrum along the last axis, normalized
+        by the window size.
+    """
+    frames *= window
+    spectra = rfft(frames, n_fft, workers)
+    spectra /= frames.shape[-1]
+    return spectra
+
+
+def interpolation_weights(x, xp):
+    """
+    Returns the indices and weights of the linear interpolation at the
+    positions x between the samples at xp, like np.interp with left=0 and
+    right=0.
+
+    Returns:
+        A tuple of the lower and upper indices and their float32 weights.
+    """
+    n = len(xp)
+    idx = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, max(n - 2, 0))
+    upper = np.minimum(idx + 1, n - 1)
+    step = xp[upper] - xp[idx]
+    w_hi = np.divide(x - xp[idx], step, out=np.zeros_like(x), where=step > 0)
+    w_lo = 1 - w_hi
+    outside = (x < xp[0]) | (x > xp[-1])
+    w_lo[outside] = 0
+    w_hi[outside] = 0
+    return idx, upper, w_lo.astype(np.float32), w_hi.astype(np.float32)
+
+
+class LogFrequencyMap:
+    """
+    Precomputed mapping of linearly spaced FFT bins onto logarithmically
+    spaced output pixels. The mapping is stored as indices and weights so
+    whole batches of spectra can be mapped with one gather and multiply.
+
+    Args:
+        n_bins (int) The number of FFT bins, spanning 0 to nyquist.
+        nyquist (float) The frequency of the last bin.
+        min_freq (float) The frequency of the first pixel.
+        max_freq (float) The frequency of the last pixel.
+        n_output (int) The number of output pixels.
+        logbase (float) The base of the logarithmic scale.
+        band_mode (str, optional) "INTERPOLATE" to linearly interpolate the
+            bins, "MEAN" or "MAX" to aggregate all bins that fall into a
+            pixel. Pixels covering less than two bins are interpolated.
+    """
+
+    def __init__(self, n_bins: int, nyquist: float, min_freq: float, max_freq: float,
+                 n_output: int, logbase: float, band_mode: str = "INTERPOLATE"):
+        if band_mode not in {"INTERPOLATE", "MEAN", "MAX"}:
+            raise ValueError(f"Unknown band mode {band_mode}")
+        self.band_mode = band_mode
+
+        # Frequencies in logspace
+        min_v = np.log(min_freq)/np.log(logbase)
+        max_v = np.log(max_freq)/np.log(logbase)
+        # Calculate evaluating positions
+        x = np.logspace(min_v, max_v, num=n_output, base=logbase)
+        # Array of original sample positions
+        xp = np.linspace(0, nyquist, num=n_bins)
+
+        self.idx_lo, self.idx_hi, self.w_lo, self.w_hi = interpolation_weights(x, xp)
+
+        # Bins falling into each pixel, the pixel borders lie halfway
+        # between the pixel centers on the log scale.
+        self.band = None
+        if band_mode != "INTERPOLATE" and n_output > 1:
+            lx = np.log(x)
+            half_step = (lx[1] - lx[0])/2
+            edges = np.exp(np.concatenate(([lx[0] - half_step],
+                                           (lx[:-1] + lx[1:])/2,
+                                           [lx[-1] + half_step])))
+            start = np.searchsorted(xp, edges[:-1], side="left")
+            stop = np.searchsorted(xp, edges[1:], side="left")
+            band = np.nonzero(stop - start >= 2)[0]
+            if len(band):
+                self.band = band
+                self.band_count = (stop - start)[band].astype(np.float32)
+                # Start and stop alternating for reduceat
+                self.band_bounds = np.stack((start[band], stop[band]), axis=1).ravel()
+
+    def __call__(self, values, interpolate_only: bool = False):
+        """
+        Maps the values of the FFT bins onto the output pixels.
+
+        Args:
+            values (np.ndarray) Array with the FFT bins on the last axis.
+            interpolate_only (bool, optional) If true the band aggregation is
+                skipped, which is needed for values like phases.
+        Returns:
+            An array with the pixels on the last axis.
+        """
+        res = values[..., self.idx_lo] * self.w_lo
+        res += values[..., self.idx_hi] * self.w_hi
+
+        if self.band is not None and not interpolate_only:
+            # Pad with one bin so stop indices at the end are valid
+            padded = np.concatenate((values, np.zeros_like(values[..., :1])), axis=-1)
+            if self.band_mode == "MEAN":
+                reduced = np.add.reduceat(padded, self.band_bounds, axis=-1)[..., ::2]
+                reduced /= self.band_count
+            else:
+                reduced = np.maximum.reduceat(padded, self.band_bounds, axis=-1)[..., ::2]
+            res[..., self.band] = reduced
+        return res
+
+
+# Conversion of frequencies in Hz to each perceptual scale and back.
+# Bark uses the formula of Traunmueller.
+FREQUENCY_SCALES = {
+    "CQT": (np.log, np.exp),
+    "MEL": (lambda f: 2595*np.log10(1 + f/700), lambda m: 700*(10**(m/2595) - 1)),
+    "BARK": (lambda f: 26.81*f/(1960 + f) - 0.53, lambda z: 1960*(z + 0.53)/(26.28 - z)),
+}
+
+
+class FilterBank:
+    """
+    Precomputed bank of overlapping triangular filters over the FFT bins,
+    an alternative to LogFrequencyMap. The filter centers are equally
+    spaced on the selected scale. Every filter rises from the center of
+    the previous filter to its own center and falls to the center of the
+    next one, so with "CQT" all filters have the same Q. Filters narrower
+    than the bin spacing are widened to the neighbouring bins.
+
+    Each filter returns the weighted mean of its bins. The kernel is sparse,
+    it is stored as bin indices and weights and applied to whole batches
+    of spectra with one gather, multiply and reduceat.
+
+    Args:
+        n_bins (int) The number of FFT bins, spanning 0 to nyquist.
+        nyquist (float) The frequency of the last bin.
+        min_freq (float) The center of the first filter.
+        max_freq (float) The center of the last filter.
+        n_output (int) The number of filters.
+        scale (str) "CQT", "MEL" or "BARK".
+    """
+
+    def __init__(self, n_bins: int, nyquist: float, min_freq: float, max_freq: float,
+                 n_output: int, scale: str):
+        if scale not in FREQUENCY_SCALES:
+            raise ValueError(f"Unknown filterbank scale {scale}")
+        to_scale, from_scale = FREQUENCY_SCALES[scale]
+
+        # The centers and one more point on each side for the outer edges
+        lo_v, hi_v = to_scale(min_freq), to_scale(max_freq)
+        step = (hi_v - lo_v)/(n_output - 1) if n_output > 1 else 1
+        points = from_scale(lo_v + step*np.arange(-1, n_output + 1))
+        centers = points[1:-1]
+        xp = np.linspace(0, nyquist, num=n_bins)
+        spacing = xp[1] - xp[0] if n_bins > 1 else 1
+
+        lower = np.minimum(points[:-2], centers - spacing)
+        upper = np.maximum(points[2:], centers + spacing)
+        start = np.minimum(np.searchsorted(xp, lower, side="right"), n_bins - 1)
+        stop = np.maximum(np.searchsorted(xp, upper, side="left"), start + 1)
+        stop = np.minimum(stop, n_bins)
+        # reduceat needs at least one element per filter
+        counts = np.maximum(stop - start, 1)
+
+        # Flat list of the bins of all filters
+        self.offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        filter_idx = np.repeat(np.arange(n_output), counts)
+        self.cols = start[filter_idx] + np.arange(counts.sum()) - self.offsets[filter_idx]
+
+        f = xp[self.cols]
+        c = centers[filter_idx]
+        rising = (f - lower[filter_idx])/(c - lower[filter_idx])
+        falling = (upper[filter_idx] - f)/(upper[filter_idx] - c)
+        weights = np.clip(np.where(f <= c, rising, falling), 0, None)
+        # Filters above nyquist stay zero
+        weights[c > nyquist] = 0
+
+        sums = np.add.reduceat(weights, self.offsets)
+        weights /= np.where(sums > 0, sums, 1)[filter_idx]
+        self.weights = weights.astype(np.float32)
+
+        # Values like phases are interpolated at the centers
+        self.idx_lo, self.idx_hi, self.w_lo, self.w_hi = interpolation_weights(centers, xp)
+
+    def __call__(self, values, interpolate_only: bool = False):
+        """
+        Applies the filters to the values of the FFT bins.
+
+        Args:
+            values (np.ndarray) Array with the FFT bins on the last axis.
+            interpolate_only (bool, optional) If true the values are only
+                interpolated at the filter centers, which is needed for
+                values like phases.
+        Returns:
+            An array with the filter outputs on the last axis.
+        """
+        if interpolate_only:
+            res = values[..., self.idx_lo] * self.w_lo
+            res += values[..., self.idx_hi] * self.w_hi
+            return res
+        weighted = values[..., self.cols] * self.weights
+        return np.add.reduceat(weighted, self.offsets, axis=-1)
+
+
+# Weight below which the memory of the temporal filters is cut off, less
+# than one step of a 16 bit image
+TEMPORAL_TOLERANCE = 2**-16
+
+
+def _smoothing_coefficient(seconds: float, fps: float):
+    """
+    Returns the part of the distance to the input that an exponential
+    smoothing with the time constant covers per frame, 1 for no smoothing.
+    """
+    if seconds <= 0:
+        return 1.0
+    return 1 - np.exp(-1/(seconds*fps))
+
+
+def _memory(coefficient: float):
+    """
+    Returns the number of frames until the weight of a past frame in an
+    exponential smoothing falls below TEMPORAL_TOLERANCE.
+    """
+    if coefficient >= 1:
+        return 0
+    return int(np.ceil(np.log(TEMPORAL_TOLERANCE)/np.log(1 - coefficient)))
+
+
+class TemporalFilter:
+    """
+    Smoothes blocks of frames over time, the first axis. The recurrences
+    run over the frames and are vectorized over all remaining axes.
+
+    "AVERAGE": The mean of each frame and the previous frame.
+    "ENVELOPE": Exponential smoothing that follows rising values with the
+        attack and falling values with the release time.
+    "PEAK_HOLD": Holds the highest value, which decays with the release time.
+
+    Consecutive blocks continue the filter exactly if each block starts
+    from the state the previous one returned. The filters also forget the
+    past exponentially, so a block is filtered independently of the others
+    if it is extended by `before` frames in front and `after` frames behind
+    it, without a state everything before a block is zero. With zero_phase
+    the filter runs forward and then backward over the frames, which
+    removes the delay of the smoothing. The backward pass always needs the
+    `after` frames.
+
+    Args:
+        mode (str) "AVERAGE", "ENVELOPE" or "PEAK_HOLD".
+        fps (float) The frames per second.
+        attack (float, optional) The attack time in seconds of "ENVELOPE".
+        release (float, optional) The release time in seconds of "ENVELOPE"
+            and decay time of "PEAK_HOLD".
+        zero_phase (bool, optional) If true the filter is applied forward
+            and backward.
+    """
+
+    def __init__(self, mode: str, fps: float, attack: float = 0.01, release: float = 0.2,
+                 zero_phase: bool = False):
+        if mode not in ("AVERAGE", "ENVELOPE", "PEAK_HOLD"):
+            raise ValueError(f"Unknown temporal filter {mode}")
+        self.mode = mode
+        self.zero_phase = zero_phase
+        self.attack = _smoothing_coefficient(attack, fps)
+        self.release = _smoothing_coefficient(release, fps)
+
+        if mode == "AVERAGE":
+            memory = 1
+        elif mode == "ENVELOPE":
+            memory = max(_memory(self.attack), _memory(self.release))
+        else:
+            memory = _memory(self.release)
+        self.before = memory
+        self.after = memory if zero_phase else 0
+
+    def __call__(self, values, state=None, n_frames: int = None):
+        """
+        Filters a block of frames in place.
+
+        Args:
+            values (np.ndarray) Array of shape (frames, ...).
+            state (np.ndarray, optional) The state returned for the previous
+                block, the block starts right after it. Without it the
+                frames before the block are zero.
+            n_frames (int, optional) The frames of the block the returned
+                state follows, the frames behind them are the lookahead of
+                zero_phase. Defaults to all frames.
+        Returns:
+            The state after the first n_frames frames for the next block.
+        """
+        state = self._forward(values, state, len(values) if n_frames is None else n_frames)
+        if self.zero_phase:
+            self._forward(values[::-1])
+        return state
 
-    window = 0.35875 + alpha[0] * np.cos(2*terms) \
-     + alpha[1] * np.cos(4*terms) + alpha[2] * np.cos(6*terms)
+    def _forward(self, values, state=None, n_frames: int = None):
+        """
+        Runs the filter forward over the frames, returns the state after
+        n_frames frames if given.
+        """
+        if self.mode == "AVERAGE":
+            # The state is the previous frame before averaging
+            next_state = None if n_frames is None else values[n_frames - 1].copy()
+            # Same operations as the former pingpong buffer, back to front
+            # so the previous frames are not yet averaged
+            for i in range(len(values) - 1, 0, -1):
+                values[i] *= .5
+                values[i] += .5*values[i - 1]
+            values[0] *= .5
+            if state is not None:
+                values[0] += .5*state
+            return next_state
 
-    samples *= window
+        state = np.zeros_like(values[0]) if state is None else state.copy()
+        next_state = None
+        diff = np.empty_like(state)
+        decay = 1 - self.release
+        for i, frame in enumerate(values):
+            if self.mode == "ENVELOPE":
+                np.subtract(frame, state, out=diff)
+                state += np.where(diff > 0, self.attack, self.release).astype(diff.dtype)*diff
+            else:
+                state *= decay
+                np.maximum(state, frame, out=state)
+            frame[...] = state
+            if i + 1 == n_frames:
+                next_state = state.copy()
+        return next_state
@@ -0,0 +1,142 @@
+"""
+File containing functions for reading audio files. Blenders audaspace is
+used if available, otherwise only wave files are supported.
+"""
+import wave
+
+import numpy as np
+
+try:
+    import aud
+except ImportError:
+    aud = None
+
+
+def _decode_pcm(raw: bytes, width: int, channels: int):
+    """
+    Converts raw little endian PCM data to float32 samples of shape
+    (samples, channels).
+    """
+    if width == 1:
+        data = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128)/128
+    elif width == 2:
+        data = np.frombuffer(raw, dtype="<i2").astype(np.float32)/2**15
+    elif width == 3:
+        # Extend the 24 bit samples to 32 bit
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        data = np.zeros((len(b), 4), dtype=np.uint8)
+        data[:, 1:] = b
+        data = data.view("<i4").ravel().astype(np.float32)/2**31
+    elif width == 4:
+        data = np.frombuffer(raw, dtype="<i4").astype(np.float32)/2**31
+    else:
+        raise ValueError(f"Unsupported sample width {width}")
+    return data.reshape(-1, channels)
+
+
+class AudioStream:
+    """
+    Random access reader for blocks of an audio file. Only the requested
+    blocks are decoded, so the memory does not depend on the file length.
+
+    Args:
+        path (str) The path of the audio file.
+    """
+
+    def __init__(self, path: str):
+        if aud is not None:
+            self.sound = aud.Sound(path)
+            self.samplerate, self.channels = self.sound.specs
+            self.n_samples = self.sound.length
+            self.wave = None
+        else:
+            self.sound = None
+            self.wave = wave.open(path, "rb")
+            self.samplerate = self.wave.getframerate()
+            self.channels = self.wave.getnchannels()
+            self.n_samples = self.wave.getnframes()
+        self.samplerate = int(self.samplerate)
+
+    def _read_raw(self, start: int, stop: int):
+        """
+        Reads the samples from start to stop, both inside the file.
+        """
+        if self.sound is not None:
+            data = self.sound.limit(start/self.samplerate, stop/self.samplerate).data()
+        else:
+            self.wave.setpos(start)
+            raw = self.wave.readframes(stop - start)
+            data = _decode_pcm(raw, self.wave.getsampwidth(), self.channels)
+        return data
+
+    def read(self, start: int, stop: int, out=None):
+        """
+        Reads the samples from start to stop and sums them to mono.
+        Samples outside the file are 0.
+
+        Args:
+            start (int) The first sample, may be negative.
+            stop (int) The sample after the last one, may be after the end.
+            out (np.ndarray, optional) float32 buffer of length stop - start.
+        Returns:
+            A 1D float32 array with the samples.
+        """
+        if out is None:
+            out = np.zeros(stop - start, dtype=np.float32)
+        else:
+            out[:] = 0
+        lo = min(max(start, 0), self.n_samples)
+        hi = min(max(stop, 0), self.n_samples)
+        if hi > lo:
+            data = self._read_raw(lo, hi)
+            # Decoders may return a sample more or less than requested
+            n = min(len(data), hi - lo)
+            np.mean(data[:n], axis=1, out=out[lo - start:lo - start + n])
+        return out
+
+    def read_channels(self, start: int, stop: int, n_channels: int = 2, downmix: bool = False):
+        """
+        Reads the samples from start to stop with separate channels.
+        Mono files are repeated into every channel, files with more channels
+        than requested are cut. Samples outside the file are 0.
+
+        Args:
+            start (int) The first sample, may be negative.
+            stop (int) The sample after the last one, may be after the end.
+            n_channels (int, optional) The number of channels to return.
+            downmix (bool, optional) If true the mean of all channels of the
+                file follows as an extra row, like read.
+        Returns:
+            A float32 array of shape (n_channels + downmix, stop - start).
+        """
+        out = np.zeros((n_channels + downmix, stop - start), dtype=np.float32)
+        lo = min(max(start, 0), self.n_samples)
+        hi = min(max(stop, 0), self.n_samples)
+        if hi > lo:
+            data = self._read_raw(lo, hi)
+            n = min(len(data), hi - lo)
+            channels = np.minimum(np.arange(n_channels), data.shape[1] - 1)
+            out[:n_channels, lo - start:lo - start + n] = data[:n, channels].T
+            if downmix:
+                np.mean(data[:n], axis=1, out=out[n_channels, lo - start:lo - start + n])
+        return out
+
+    def blocks(self, block_size: int = 1 << 18):
+        """
+        Yields the whole file as consecutive mono blocks.
+        """
+        for start in range(0, self.n_samples, block_size):
+            yield self.read(start, min(start + block_size, self.n_samples))
+
+    def peak(self):
+        """
+        Returns the highest absolute mono sample with a streaming pass.
+        """
+        peak = 0.0
+        for block in self.blocks():
+            peak = max(peak, float(np.max(np.abs(block), initial=0)))
+        return peak
+
+    def close(self):
+        if self.wave is not None:
+            self.wave.close()
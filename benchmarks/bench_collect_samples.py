@@ -0,0 +1,59 @@
+"""
+Microbenchmark comparing collect_samples_safe with the former per-element
+implementation.
+
+Run with `python benchmarks/bench_collect_samples.py` from the addon folder.
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from audio_helpers import collect_samples_safe  # noqa: E402
+
+
+def collect_samples_loop(arr, center: int, width: int, dtype=np.float32):
+    """
+    The former implementation which copies every sample in a python loop.
+    """
+    if arr.ndim != 1:
+        raise ValueError("Array is not 1D")
+
+    buffer = np.zeros(width, dtype=dtype)
+
+    for i in range(width):
+        sel = i - width//2 + center
+        if sel < 0:
+            continue
+        if sel >= len(arr):
+            break
+        buffer[i] = arr[sel]
+    return buffer
+
+
+def main():
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-1, 1, 44100*10).astype(np.float32)
+
+    print(f"{'width':>8} {'loop [us]':>12} {'slice [us]':>12} {'slice+out [us]':>15} {'speedup':>8}")
+    for width in (1024, 2048, 4096, 8192, 16384):
+        # Check for identical results, including both borders
+        for center in (0, width//4, len(data)//2, len(data) - width//4, len(data) + width):
+            expected = collect_samples_loop(data, center, width)
+            if not np.array_equal(expected, collect_samples_safe(data, center, width)):
+                raise AssertionError(f"Mismatch for width {width} at center {center}")
+
+        out = np.empty(width, dtype=np.float32)
+        center = len(data)//2
+        n = max(10, 200000//width)
+        t_loop = timeit.timeit(lambda: collect_samples_loop(data, center, width), number=n)/n
+        t_slice = timeit.timeit(lambda: collect_samples_safe(data, center, width), number=n*10)/(n*10)
+        t_out = timeit.timeit(lambda: collect_samples_safe(data, center, width, out=out), number=n*10)/(n*10)
+        print(f"{width:>8} {t_loop*1e6:>12.1f} {t_slice*1e6:>12.2f} {t_out*1e6:>15.2f} {t_loop/t_out:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Benchmark of the spectrum pipeline without blender. Every stage runs on
+synthetic audio and is timed on its own, the end to end export is timed as
+a whole. The report is written as JSON.
+
+Run with `python benchmarks/bench_pipeline.py --seconds 60` from the addon
+folder, `--help` lists all options.
+"""
+import argparse
+import dataclasses
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on windows
+    resource = None
+
+ADDON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Make sure the blender modules are not used, even if installed as packages
+sys.modules["bpy"] = None
+sys.modules["aud"] = None
+sys.path.insert(0, os.path.dirname(os.path.abspath(ADDON_DIR)))
+
+addon = os.path.basename(os.path.abspath(ADDON_DIR))
+audio_helpers = importlib.import_module(f"{addon}.audio_helpers")
+audio_io = importlib.import_module(f"{addon}.audio_io")
+image_helpers = importlib.import_module(f"{addon}.image_helpers")
+spectrumcore = importlib.import_module(f"{addon}.spectrumcore")
+
+
+def synthetic_audio(seconds: float, samplerate: int, seed: int = 0):
+    """
+    Returns mono float32 samples of a logarithmic sweep with noise and beats.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds*samplerate))/samplerate
+    sweep = np.sin(2*np.pi*20*seconds/np.log(1000)*(1000**(t/seconds) - 1))
+    beats = np.exp(-20*(t % 0.5))*rng.standard_normal(len(t))
+    return (0.4*sweep + 0.3*beats + 0.05*rng.standard_normal(len(t))).astype(np.float32)
+
+
+def write_wave(path: str, data, samplerate: int):
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes((np.clip(data, -1, 1)*32767).astype("<i2").tobytes())
+
+
+class StageTimer:
+    """
+    Sums the time of named stages.
+    """
+
+    def __init__(self):
+        self.times = {}
+
+    def __call__(self, name: str, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+        return result
+
+
+def bench_stages(data, samplerate: int, wave_path: str, settings, encode_frames: int):
+    """
+    Runs every stage of the pipeline over all frames, one chunk at a time.
+
+    Returns:
+        A dict mapping the stages to their total time in seconds.
+    """
+    timer = StageTimer()
+
+    # Streaming decode of the whole file
+    stream = audio_io.AudioStream(wave_path)
+    timer("decode", lambda: [None for _ in stream.blocks()])
+
+    # The source of the export, it decodes the blocks of the frames
+    source = spectrumcore.StreamingSource(stream, settings, float(np.max(np.abs(data), initial=0)))
+    analysis = spectrumcore.SpectrumAnalysis(source, settings)
+    assembler = spectrumcore.FrameAssembler(analysis)
+    window = source.window
+    n_fft = analysis.n_fft
+
+    # The per frame gather and window of the former implementation
+    for center in source.centers:
+        samples = timer("collect_samples_safe", audio_helpers.collect_samples_safe,
+                        data, int(center), settings.window_size)
+        timer("blackman_harris_window", audio_helpers.blackman_harris_window, samples)
+
+    encoded = 0
+    for frame_ids in analysis.chunks():
+        # The chunks are extended by the frames the smoothing needs
+        padded_ids = analysis.padded(frame_ids)
+        frames = timer("frames", source.read, padded_ids)
+        frames = timer("window", np.multiply, frames, window, out=frames)
+        spectra = timer("fft", audio_helpers.rfft, frames, n_fft)
+        spectra /= settings.window_size
+        spectra *= analysis.scale
+
+        # The stages of process_spectra on their own
+        freqs = timer("magnitude", np.abs, spectra)
+        if settings.use_db:
+            timer("db", _to_db, freqs, analysis)
+        if analysis.log_map is not None:
+            timer("log_map", analysis.log_map, freqs)
+
+        pixels = timer("postprocess", analysis.process_spectra, spectra)
+        if analysis.temporal_filter is not None:
+            # In frame order, so the state continues from the previous chunk
+            pixels = timer("smooth", analysis.smooth_chunk, frame_ids, padded_ids, pixels)
+        for frame_id, frame in zip(frame_ids, pixels):
+            img = timer("assemble", assembler.add, frame)
+            if encoded < encode_frames:
+                quantized = timer("quantize", image_helpers.quantize, img, int(settings.color_depth),
+                                  spectrumcore.image_channels(settings))
+                timer("encode", image_helpers.encode_png, quantized, settings.compression)
+                encoded += 1
+
+    if encoded:
+        # Extrapolate the encoding to all frames
+        factor = analysis.n_frames_total/encoded
+        timer.times["quantize"] *= factor
+        timer.times["encode"] *= factor
+    stream.close()
+    return timer.times
+
+
+def _to_db(freqs, analysis):
+    # Same conversion as in process_spectra
+    settings = analysis.settings
+    np.maximum(freqs, analysis.min_gain, out=freqs)
+    np.log10(freqs, out=freqs)
+    freqs *= 20/-settings.minimum_db
+    freqs += 1
+    np.maximum(freqs, 0, out=freqs)
+    return freqs
+
+
+def bench_export(wave_path: str, out_dir: str, settings, n_workers: int, n_processes: int):
+    """
+    Times the complete export of a file.
+
+    Returns:
+        A tuple of the time in seconds and the number of frames.
+    """
+    values = dataclasses.asdict(settings)
+    values["use_cache"] = False
+    values["resume"] = False
+    n_frames = []
+    start = time.perf_counter()
+    spectrumcore.export_spectrum(wave_path, out_dir, name="bench",
+                                 n_workers=n_workers, n_processes=n_processes,
+                                 progress=lambda done, total: n_frames.append(total), **values)
+    return time.perf_counter() - start, n_frames[-1]
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident memory of the process in MB, None if unknown.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere
+    return rss/2**20 if sys.platform == "darwin" else rss/2**10
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the spectrum pipeline on synthetic audio.")
+    parser.add_argument("--seconds", type=float, default=30, help="Length of the audio.")
+    parser.add_argument("--samplerate", type=int, default=44100)
+    parser.add_argument("--window_size", type=int, default=1024)
+    parser.add_argument("--zero_extension", type=int, default=1024)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--n_output", type=int, default=2048)
+    parser.add_argument("--hist", type=int, default=0)
+    parser.add_argument("--output_mode", default="SEQUENCE", choices=["SEQUENCE", "ATLAS", "NPY"])
+    parser.add_argument("--output_channels", default="MAGNITUDE_PHASE", choices=["MAGNITUDE_PHASE", "MAGNITUDE", "PHASE"])
+    parser.add_argument("--max_freq", type=float, default=21050)
+    parser.add_argument("--time_smoothing", action="store_true")
+    parser.add_argument("--smoothing_mode", default="AVERAGE", choices=["AVERAGE", "ENVELOPE", "PEAK_HOLD"])
+    parser.add_argument("--zero_phase", action="store_true")
+    parser.add_argument("--decimate", action="store_true",
+                        help="Decimate the audio in the end to end export, the stage benchmark uses the full rate.")
+    parser.add_argument("--encode_frames", type=int, default=100,
+                        help="Frames encoded in the stage benchmark, the time is extrapolated to all frames.")
+    parser.add_argument("--workers", type=int, default=None, help="Threads of the end to end export.")
+    parser.add_argument("--processes", type=int, default=None, help="Encoding processes of the end to end export.")
+    parser.add_argument("--skip_export", action="store_true", help="Only run the stage benchmark.")
+    parser.add_argument("--json", help="Write the report to this file instead of stdout.")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    settings = spectrumcore.SpectrumSettings(window_size=args.window_size,
+                                             zero_extension=args.zero_extension,
+                                             fps=args.fps,
+                                             n_output=args.n_output,
+                                             hist=args.hist,
+                                             output_mode=args.output_mode,
+                                             output_channels=args.output_channels,
+                                             max_freq=args.max_freq,
+                                             time_smoothing=args.time_smoothing,
+                                             smoothing_mode=args.smoothing_mode,
+                                             zero_phase=args.zero_phase,
+                                             decimate=args.decimate)
+    data = synthetic_audio(args.seconds, args.samplerate)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        wave_path = os.path.join(tmp, "bench.wav")
+        write_wave(wave_path, data, args.samplerate)
+
+        tracemalloc.start()
+        stages = bench_stages(data, args.samplerate, wave_path, settings, args.encode_frames)
+        _, stages_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        n_frames = int(len(data)/args.samplerate*args.fps) + 1
+        report = {
+            "settings": {**vars(args), "n_frames": n_frames},
+            "numpy": np.__version__,
+            "scipy_fft": audio_helpers.scipy_fft is not None,
+            "stages_s": {name: round(seconds, 6) for name, seconds in stages.items()},
+            "stages_peak_mb": round(stages_peak/2**20, 2),
+        }
+
+        if not args.skip_export:
+            tracemalloc.start()
+            seconds, n_frames = bench_export(wave_path, os.path.join(tmp, "out"), settings,
+                                             args.workers, args.processes)
+            _, export_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            report["export"] = {
+                "seconds": round(seconds, 4),
+                "frames": n_frames,
+                "fps": round(n_frames/seconds, 2),
+                "peak_mb": round(export_peak/2**20, 2),
+            }
+        report["peak_rss_mb"] = peak_rss_mb()
+
+    text = json.dumps(report, indent=2)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,495 @@
+"""
+File containing functions for writing images without blender.
+"""
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+
+def _png_chunk(tag: bytes, data: bytes):
+    """
+    Packs data into a PNG chunk with length and checksum.
+    """
+    return struct.pack(">I", len(data)) + tag + data \
+        + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+
+# PNG color type of each channel count: gray, gray and alpha, RGB, RGBA
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# Width ratio of successive levels of a mip pyramid
+MIP_FACTOR = 4
+
+# Largest texture width and height of common GPUs
+ATLAS_MAX_SIZE = 16384
+
+
+def mip_width(width: int, level: int):
+    """
+    Returns the width of a level of a mip pyramid, level 0 is the full width.
+    """
+    return -(-width//MIP_FACTOR**level)
+
+
+def pool_width(values, factor: int, mode: str = "MEAN"):
+    """
+    Combines every factor neighbouring values along the last axis into one,
+    the last group may be smaller.
+
+    Args:
+        values (np.ndarray) The values, e.g. the pixel planes of a frame.
+        factor (int) The number of values per group.
+        mode (str, optional) MEAN or MAX of each group.
+    Returns:
+        An array with ceil(width/factor) values along the last axis.
+    """
+    width = values.shape[-1]
+    starts = np.arange(0, width, factor)
+    if mode == "MAX":
+        return np.maximum.reduceat(values, starts, axis=-1)
+    pooled = np.add.reduceat(values, starts, axis=-1)
+    pooled /= np.minimum(width - starts, factor).astype(pooled.dtype)
+    return pooled
+
+
+def quantize(img, color_depth: int = 8, channels=(0, 1, 2)):
+    """
+    Converts a float image to the pixel rows of a PNG. Values are clipped
+    to 0-1. Like in blender the first row of the image is the bottom row.
+
+    Args:
+        img (np.ndarray) Array of shape (height, width, channels).
+        color_depth (int, optional) 8 or 16 bits per channel.
+        channels (tuple, optional) The channels of img that are written,
+            one channel is written as gray, three as RGB and four as RGBA.
+    Returns:
+        An array of shape (height, width, len(channels)) in big endian byte
+        order.
+    """
+    if color_depth not in (8, 16):
+        raise ValueError(f"Unsupported color depth {color_depth}")
+    if len(channels) not in PNG_COLOR_TYPES:
+        raise ValueError(f"Unsupported channel count {len(channels)}")
+    max_value = 2**color_depth - 1
+    if tuple(channels) == tuple(range(len(channels))):
+        # Leading channels are a view instead of a copy
+        img = img[:, :, :len(channels)]
+    else:
+        img = img[:, :, list(channels)]
+    # PNG starts with the top row
+    pixels = np.clip(img[::-1], 0, 1)*max_value
+    return np.round(pixels).astype(np.uint8 if color_depth == 8 else ">u2")
+
+
+def display_pixels(img, channels=(0, 1, 2)):
+    """
+    Returns the float RGBA pixels blender shows for a PNG written with the
+    given channels, see quantize. A single channel is shown as gray and
+    the alpha is opaque if it is not written.
+
+    Args:
+        img (np.ndarray) Array of shape (height, width, channels).
+        channels (tuple, optional) The channels of img that are written.
+    Returns:
+        An array of shape (height, width, 4).
+    """
+    rgba = np.ones(img.shape[:2] + (4,), dtype=np.float32)
+    values = np.clip(img[:, :, list(channels)], 0, 1)
+    if len(channels) == 1:
+        rgba[:, :, :3] = values
+    else:
+        rgba[:, :, :len(channels)] = values
+    return rgba
+
+
+def encode_png(pixels, compression: int = 6):
+    """
+    Encodes quantized pixels as PNG.
+
+    Args:
+        pixels (np.ndarray) The pixels created by quantize.
+        compression (int, optional) The zlib compression level from 0 to 9.
+    Returns:
+        The bytes of the PNG file.
+    """
+    height, width, channels = pixels.shape
+    color_depth = pixels.dtype.itemsize*8
+
+    # Each row starts with the filter type, 0 means no filter
+    rows = _png_rows(pixels)
+    raw = np.zeros((height, rows.shape[1] + 1), dtype=np.uint8)
+    raw[:, 1:] = rows
+
+    return _png_header(width, height, color_depth, channels) \
+        + _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), compression)) \
+        + _png_chunk(b"IEND", b"")
+
+
+def _png_rows(pixels):
+    """
+    Returns the bytes of the pixel rows as stored in a PNG, one row per
+    image row.
+    """
+    # PNG stores 16 bit values big endian, pickling for a process pool may
+    # have converted the pixels to the native byte order
+    dtype = ">u2" if pixels.dtype.itemsize == 2 else np.uint8
+    return pixels.astype(dtype, copy=False).reshape(len(pixels), -1).view(np.uint8)
+
+
+def pixel_checksum(pixels):
+    """
+    Returns the checksum of quantized pixels as they are stored in a PNG.
+    """
+    return zlib.crc32(np.ascontiguousarray(_png_rows(pixels)))
+
+
+def _png_header(width: int, height: int, color_depth: int, channels: int = 3):
+    """
+    Returns the signature and header chunk of a PNG with the given number
+    of channels.
+    """
+    header = struct.pack(">IIBBBBB", width, height, color_depth, PNG_COLOR_TYPES[channels], 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", header)
+
+
+def _write_pixels(path: str, pixels, compression: int):
+    """
+    Encodes and writes the pixels.
+
+    Returns:
+        A tuple of the size of the file, the checksum of the pixels that
+        were encoded, see pixel_checksum, and the checksum of the file.
+    """
+    data = encode_png(pixels, compression)
+    with open(path, "wb") as f:
+        f.write(data)
+    return len(data), pixel_checksum(pixels), zlib.crc32(data)
+
+
+class FrameManifest:
+    """
+    Records the frames of an image sequence that were written completely,
+    so a rerun can skip the frames that did not change. A frame is valid if
+    the checksum of its quantized pixels matches the pixels that were
+    encoded into its file and the file still has the recorded size and
+    checksum. All frames are invalid if the settings changed.
+    The manifest is saved regularly, so it survives crashes.
+
+    Args:
+        path (str) The path of the manifest json.
+        settings (dict) The settings that change the files, but not the pixels.
+        save_interval (float, optional) Seconds between saves while recording.
+    """
+
+    def __init__(self, path: str, settings: dict, save_interval: float = 2.0):
+        self.path = path
+        self.settings_hash = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        self.save_interval = save_interval
+        self.last_save = time.monotonic()
+        self.frames = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data["settings"] == self.settings_hash:
+                self.frames = {int(frame_id): tuple(entry) for frame_id, entry in data["frames"].items()}
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    def is_valid(self, frame_id: int, checksum: int, path: str):
+        """
+        True if the file of the frame holds the pixels with the checksum.
+        """
+        entry = self.frames.get(frame_id)
+        # Entries of older manifests have no file checksum
+        if entry is None or len(entry) != 3 or entry[0] != checksum:
+            return False
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        return len(data) == entry[1] and zlib.crc32(data) == entry[2]
+
+    def forget(self, frame_id: int):
+        """
+        Marks the frame as invalid before its file is rewritten.
+        """
+        self.frames.pop(frame_id, None)
+
+    def record(self, frame_id: int, checksum: int, size: int, file_checksum: int):
+        """
+        Marks the frame as written completely, the values are returned by
+        _write_pixels.
+        """
+        self.frames[frame_id] = (checksum, size, file_checksum)
+        if time.monotonic() - self.last_save > self.save_interval:
+            self.save()
+
+    def save(self):
+        # Replace atomically, a crash must not leave a broken manifest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"settings": self.settings_hash,
+                       "frames": {str(frame_id): list(entry) for frame_id, entry in self.frames.items()}}, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+
+class FrameWriter:
+    """
+    Base class for writing the frames of an export.
+    Subclasses implement write and first_path and may override close and
+    cancel. bytes_written counts the bytes that reached the files.
+    """
+    bytes_written = 0
+
+    def first_path(self):
+        """
+        Returns the path blender should load the output from.
+        """
+        raise NotImplementedError
+
+    def write(self, frame_id: int, img):
+        """
+        Writes the pixel matrix of the zero based frame. The matrix may be
+        reused by the caller after the call returns.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Finishes all pending writes.
+        """
+
+    def cancel(self):
+        """
+        Stops writing, pending writes may be dropped.
+        """
+
+
+class PngWriter(FrameWriter):
+    """
+    Writes every frame as PNG. The pixels are quantized in the calling
+    thread, compressing and writing the files can be done by an executor,
+    e.g. a process pool.
+
+    Args:
+        prefix (str) The path of the output without frame number and extension.
+        number_format (str) The format string for the frame numbers.
+        color_depth (int, optional) 8 or 16 bits per channel.
+        compression (int, optional) The zlib compression level from 0 to 9.
+        executor (concurrent.futures.Executor, optional) Executor the files
+            are encoded on, if not given they are written directly.
+        owns_executor (bool, optional) If false the executor is shared with
+            other writers and is not shut down by close and cancel.
+        max_pending (int, optional) How many writes may be in flight.
+        channels (tuple, optional) The channels of the pixel matrix that
+            are written, see quantize.
+        manifest (FrameManifest, optional) If given, frames whose files are
+            still valid are skipped and written frames are recorded.
+    """
+    def __init__(self, prefix: str, number_format: str, color_depth: int = 8,
+                 compression: int = 6, executor=None, owns_executor: bool = True, max_pending: int = 64,
+                 channels=(0, 1, 2), manifest: FrameManifest = None):
+        self.prefix = prefix
+        self.number_format = number_format
+        self.color_depth = color_depth
+        self.channels = channels
+        self.compression = compression
+        self.executor = executor
+        self.owns_executor = owns_executor
+        self.max_pending = max_pending
+        self.manifest = manifest
+        self.skipped = 0
+        self.pending = deque()
+
+    def frame_path(self, frame_id: int):
+        """
+        Returns the path of the zero based frame.
+        """
+        return f"{self.prefix}{self.number_format.format(frame_id + 1)}.png"
+
+    def first_path(self):
+        return self.frame_path(0)
+
+    def write(self, frame_id: int, img):
+        pixels = quantize(img, self.color_depth, self.channels)
+        path = self.frame_path(frame_id)
+        if self.manifest is not None:
+            if self.manifest.is_valid(frame_id, pixel_checksum(pixels), path):
+                self.skipped += 1
+                return
+            self.manifest.forget(frame_id)
+
+        if self.executor is None:
+            self._record(frame_id, _write_pixels(path, pixels, self.compression))
+            return
+
+        # Wait for old writes, this also raises their errors
+        while len(self.pending) >= self.max_pending:
+            self._finish_oldest()
+        future = self.executor.submit(_write_pixels, path, pixels, self.compression)
+        self.pending.append((frame_id, future))
+
+    def _record(self, frame_id: int, result):
+        # The checksums come from the writing process, so they cover what
+        # reached the file
+        size, checksum, file_checksum = result
+        self.bytes_written += size
+        if self.manifest is not None:
+            self.manifest.record(frame_id, checksum, size, file_checksum)
+
+    def _finish_oldest(self):
+        frame_id, future = self.pending.popleft()
+        self._record(frame_id, future.result())
+
+    def close(self):
+        while self.pending:
+            self._finish_oldest()
+        if self.executor is not None and self.owns_executor:
+            self.executor.shutdown()
+        if self.manifest is not None:
+            self.manifest.save()
+
+    def cancel(self):
+        # Keep the frames that were written completely for the next run
+        for frame_id, future in self.pending:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._record(frame_id, future.result())
+        if self.executor is not None and self.owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            for _, future in self.pending:
+                future.cancel()
+        self.pending.clear()
+        if self.manifest is not None:
+            self.manifest.save()
+
+
+def atlas_layout(n_frames: int, width: int, max_size: int = ATLAS_MAX_SIZE):
+    """
+    Returns the number of tile columns and rows of an atlas. The frames are
+    wrapped into several columns if they don't fit into the height.
+
+    Args:
+        n_frames (int) The number of frames.
+        width (int) The width of a frame.
+        max_size (int, optional) The largest width and height of the atlas.
+    Returns:
+        A tuple of the columns and the rows.
+    """
+    columns = -(-n_frames//max_size)
+    if columns*width > max_size:
+        raise ValueError(f"{n_frames} frames of width {width} don't fit into a {max_size} pixel atlas")
+    return columns, -(-n_frames//columns)
+
+
+class AtlasPngWriter(FrameWriter):
+    """
+    Writes the newest row of every frame into one PNG. The frames are
+    tiles of one row, they fill the rows of the image left to right and
+    the top row first, see atlas_layout. The image is compressed while the
+    frames arrive, so the frames have to be written in order.
+
+    Args:
+        path (str) The path of the PNG file.
+        n_frames (int) The number of frames.
+        width (int) The width of a frame.
+        color_depth (int, optional) 8 or 16 bits per channel.
+        compression (int, optional) The zlib compression level from 0 to 9.
+        channels (tuple, optional) The channels of the pixel matrix that
+            are written, see quantize.
+    """
+    # Flush compressed data into a new IDAT chunk at this size
+    chunk_bytes = 1 << 20
+
+    def __init__(self, path: str, n_frames: int, width: int, color_depth: int = 8,
+                 compression: int = 6, channels=(0, 1, 2)):
+        self.path = path
+        self.n_frames = n_frames
+        self.columns, self.rows = atlas_layout(n_frames, width)
+        self.color_depth = color_depth
+        self.channels = channels
+        self.next_frame = 0
+        self.compressor = zlib.compressobj(compression)
+        self.buffer = bytearray()
+        # The tiles of the current image row
+        self.tiles = []
+        self.file = open(path, "wb")
+        self.file.write(_png_header(width*self.columns, self.rows, color_depth, len(channels)))
+
+    def first_path(self):
+        return self.path
+
+    def write(self, frame_id: int, img):
+        if frame_id != self.next_frame:
+            raise ValueError(f"Atlas frames must be written in order, expected {self.next_frame} got {frame_id}")
+        self.next_frame += 1
+
+        self.tiles.append(quantize(img[:1], self.color_depth, self.channels).tobytes())
+        if len(self.tiles) == self.columns:
+            self._write_row()
+
+    def _write_row(self):
+        # Row with the filter type 0 in front
+        self.buffer += self.compressor.compress(b"\x00" + b"".join(self.tiles))
+        self.tiles.clear()
+        if len(self.buffer) >= self.chunk_bytes:
+            self.bytes_written += self.file.write(_png_chunk(b"IDAT", bytes(self.buffer)))
+            self.buffer.clear()
+
+    def close(self):
+        if self.next_frame != self.n_frames:
+            raise ValueError(f"Atlas incomplete, {self.next_frame} of {self.n_frames} frames written")
+        if self.tiles:
+            # The tiles after the last frame are black
+            self.tiles += [bytes(len(self.tiles[0]))]*(self.columns - len(self.tiles))
+            self._write_row()
+        self.buffer += self.compressor.flush()
+        self.bytes_written += self.file.write(_png_chunk(b"IDAT", bytes(self.buffer)))
+        self.bytes_written += self.file.write(_png_chunk(b"IEND", b""))
+        self.file.close()
+
+    def cancel(self):
+        self.file.close()
+
+
+class NpyWriter(FrameWriter):
+    """
+    Writes the newest row of every frame as float32 into one memory mapped
+    .npy file of shape (n_frames, width, len(channels)). Row N is frame N.
+
+    Args:
+        path (str) The path of the .npy file.
+        n_frames (int) The number of frames.
+        width (int) The width of each row.
+        channels (tuple, optional) The channels of the pixel matrix that
+            are written.
+    """
+
+    def __init__(self, path: str, n_frames: int, width: int, channels=(0, 1, 2, 3)):
+        self.path = path
+        self.channels = list(channels)
+        self.data = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32,
+                                              shape=(n_frames, width, len(self.channels)))
+
+    def first_path(self):
+        return self.path
+
+    def write(self, frame_id: int, img):
+        self.data[frame_id] = img[0][:, self.channels]
+        self.bytes_written += self.data[frame_id].nbytes
+
+    def close(self):
+        if self.data is not None:
+            self.data.flush()
+            self.data = None
+
+    def cancel(self):
+        self.close()
@@ -0,0 +1,213 @@
+"""
+This module contains the on disk cache for the raw spectra of an export.
+Changing only visual settings then skips decoding and the FFT.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "audio_visualization_tools_cache")
+
+# Settings that change the raw spectra, everything else is post-processing
+ANALYSIS_FIELDS = ("window_size", "zero_extension", "window_type", "stereo_mode", "fps")
+
+# Seconds after which incomplete entries are removed, e.g. of a crashed export
+STALE_ENTRY_AGE = 24*60*60
+
+
+def file_hash(path: str, block_size: int = 1 << 20):
+    """
+    Returns a hash of the contents, size and modification time of a file.
+    """
+    stat = os.stat(path)
+    h = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(audio_hash: str, settings):
+    """
+    Returns the cache key of the raw spectra of an audio file.
+
+    Args:
+        audio_hash (str) The hash of the audio file created by file_hash.
+        settings (SpectrumSettings) The settings of the export, only the
+            fields in ANALYSIS_FIELDS and the decimation are part of the key.
+    Returns:
+        The key as hex string.
+    """
+    analysis = {name: getattr(settings, name) for name in ANALYSIS_FIELDS}
+    if settings.decimate and settings.logscale:
+        # The decimation factor follows from the highest frequency
+        analysis["decimate_below"] = settings.max_freq
+    key = json.dumps([audio_hash, analysis], sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class CacheEntry:
+    """
+    A raw spectrum cache entry that is being written. The spectra are
+    written through a memory map, rows may be filled from several threads.
+    commit makes the entry visible to SpectrumCache.get.
+
+    Args:
+        cache (SpectrumCache) The cache the entry belongs to.
+        key (str) The key of the entry.
+        shape (tuple) The shape of the raw spectra, (frames, bins).
+        meta (dict) Additional values stored with the spectra.
+    """
+
+    def __init__(self, cache, key: str, shape, meta: dict):
+        self.cache = cache
+        self.key = key
+        self.meta = meta
+        self.tmp_path = cache.path(key, f".{os.getpid()}.tmp.npy")
+        self.spectra = np.lib.format.open_memmap(self.tmp_path, mode="w+",
+                                                 dtype=np.complex64, shape=shape)
+
+    def commit(self):
+        """
+        Finishes the entry and evicts old entries if the cache is too large.
+        """
+        self.spectra.flush()
+        self.spectra = None
+        os.replace(self.tmp_path, self.cache.path(self.key, ".npy"))
+        with open(self.cache.path(self.key, ".json"), "w") as f:
+            json.dump(self.meta, f)
+        self.cache.evict()
+
+    def discard(self):
+        """
+        Removes the incomplete entry.
+        """
+        self.spectra = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            # Already removed or still mapped on windows, evict removes it later
+            pass
+
+
+class SpectrumCache:
+    """
+    Directory of memory mapped raw spectra. If the total size exceeds
+    max_bytes the least recently used entries are removed.
+
+    Args:
+        directory (str, optional) The directory of the cache.
+        max_bytes (int, optional) The maximum total size of the cache.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = 2 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str, suffix: str):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key: str):
+        """
+        Returns the read only spectra and the stored values of an entry.
+
+        Returns:
+            A tuple of the memory mapped spectra and the meta dict, or None if
+            the key is not cached.
+        """
+        meta_path = self.path(key, ".json")
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            spectra = np.load(self.path(key, ".npy"), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        # The modification time of the meta file marks the last use
+        os.utime(meta_path)
+        return spectra, meta
+
+    def get_peak(self, audio_hash: str):
+        """
+        Returns the cached peak of an audio file or None.
+        """
+        try:
+            with open(self.path(audio_hash, ".peak")) as f:
+                return float(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set_peak(self, audio_hash: str, peak: float):
+        """
+        Stores the peak of an audio file.
+        """
+        with open(self.path(audio_hash, ".peak"), "w") as f:
+            f.write(repr(peak))
+
+    def create(self, key: str, shape, meta: dict):
+        """
+        Creates a new entry that has to be committed once it is filled.
+        """
+        return CacheEntry(self, key, shape, meta)
+
+    def entries(self):
+        """
+        Returns the keys, last use and size of all complete entries.
+        """
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            key = filename[:-len(".json")]
+            try:
+                last_use = os.path.getmtime(self.path(key, ".json"))
+                size = os.path.getsize(self.path(key, ".npy"))
+            except OSError:
+                continue
+            entries.append((key, last_use, size))
+        return entries
+
+    def remove(self, key: str):
+        for suffix in (".json", ".npy"):
+            try:
+                os.remove(self.path(key, suffix))
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits
+        max_bytes and the incomplete entries older than STALE_ENTRY_AGE.
+        """
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".tmp.npy"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                if now - os.path.getmtime(path) > STALE_ENTRY_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    def clear(self):
+        """
+        Removes all entries and peaks.
+        """
+        for key, _, _ in self.entries():
+            self.remove(key)
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".peak"):
+                os.remove(os.path.join(self.directory, filename))
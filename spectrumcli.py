@@ -0,0 +1,62 @@
+"""
+Command line interface for the spectrum export. Runs without the blender UI,
+either inside `blender --background` or with a plain python interpreter:
+
+    python -m <addon folder>.spectrumcli song.wav ./fftimg/ --fps 24
+    blender --background --python-expr "import sys; from <addon folder> import spectrumcli; spectrumcli.main(sys.argv[sys.argv.index('--')+1:])" -- ./tracks/ ./fftimg/
+"""
+import argparse
+import dataclasses
+import os
+import sys
+
+from . spectrumcore import SpectrumSettings, export_directory, export_spectrum
+
+
+def _parse_bool(value: str):
+    if value.lower() in {"1", "true", "yes", "on"}:
+        return True
+    if value.lower() in {"0", "false", "no", "off"}:
+        return False
+    raise argparse.ArgumentTypeError(f"Expected a boolean, got {value}")
+
+
+def build_parser():
+    """
+    Creates the argument parser, every field of SpectrumSettings is an option.
+    """
+    parser = argparse.ArgumentParser(description="Export the spectrum of audio files as image sequences.")
+    parser.add_argument("input", help="Audio file or directory with audio files.")
+    parser.add_argument("output", help="Directory the image sequences are written to.")
+    parser.add_argument("--name", help="Name of the sequence, only for single files.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of threads for a single file or processes for a directory.")
+
+    for field in dataclasses.fields(SpectrumSettings):
+        arg_type = _parse_bool if field.type in (bool, "bool") else \
+            {"int": int, "float": float, "str": str}.get(field.type, field.type)
+        parser.add_argument(f"--{field.name}", type=arg_type, default=field.default,
+                            help=f"Default: {field.default}")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    settings = {field.name: getattr(args, field.name) for field in dataclasses.fields(SpectrumSettings)}
+
+    if os.path.isdir(args.input):
+        results = export_directory(args.input, args.output, n_processes=args.workers, **settings)
+        for audio_path, first_image in results.items():
+            print(f"{audio_path} -> {first_image}")
+    else:
+        def progress(done, total):
+            print(f"\r{done}/{total} frames", end="", file=sys.stderr)
+
+        first_image = export_spectrum(args.input, args.output, name=args.name,
+                                      n_workers=args.workers, progress=progress, **settings)
+        print(file=sys.stderr)
+        print(f"{args.input} -> {first_image}")
+
+
+if __name__ == "__main__":
+    main()
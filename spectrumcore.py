@@ -0,0 +1,1647 @@
+"""
+This module contains the spectrum export pipeline. It does not depend on
+blender, so it is shared by the export operator and the command line
+interface.
+"""
+import contextlib
+import dataclasses
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from . audio_helpers import FilterBank, LogFrequencyMap, TemporalFilter, decimate_windows, decimation_factor, \
+    decimation_filter, frame_centers, get_boost_curve, get_rolloff_curve, get_window, next_fast_len, \
+    windowed_rfft
+from . audio_io import AudioStream
+from . image_helpers import MIP_FACTOR, AtlasPngWriter, FrameManifest, NpyWriter, PngWriter, mip_width, pool_width
+from . spectrumcache import SpectrumCache, cache_key, file_hash
+
+# Frames per task of the worker pool
+CHUNK_SIZE = 30
+# Chunks are at least this many times longer than the frames behind them
+# the zero phase smoothing needs
+SMOOTHING_CHUNK_RATIO = 8
+
+# Scheduling of the interactive export per mode: seconds between the timer
+# events, seconds of work per event, whether to wait for the workers and how
+# many cores are left free for the UI
+SCHEDULE_MODES = {
+    "BACKGROUND": (0.1, 0.01, False, 1),
+    "BALANCED": (0.02, 0.05, False, 0),
+    "THROUGHPUT": (0.001, 0.5, True, 0),
+}
+
+# Frames the preview keeps in memory, the least recently used are dropped
+PREVIEW_CACHE_FRAMES = 512
+
+# Frames after the shown one that the preview calculates in the background
+PREVIEW_PREFETCH = CHUNK_SIZE
+
+# Settings that only change how the frames are written, not their pixels
+OUTPUT_FIELDS = ("output_mode", "mip_levels", "mip_pooling", "resume", "color_depth", "compression", "use_cache",
+                 "cache_size", "collect_stats")
+
+# Settings a preset of an export job changes, the others come from the export
+PRESET_FIELDS = ("logscale", "min_freq", "max_freq", "n_output", "use_db", "minimum_db", "hist",
+                 "time_smoothing", "smoothing_mode")
+
+# Number of extra magnitude planes of each stereo mode, written to blue and alpha
+STEREO_PLANES = {"NONE": 0, "SIDE": 1, "LEFT_RIGHT": 2}
+
+AUDIO_EXTENSIONS = {".wav", ".flac", ".mp3", ".ogg", ".aac", ".m4a", ".aiff", ".aif"}
+
+
+@dataclasses.dataclass
+class SpectrumSettings:
+    """
+    The settings of a spectrum export. The names and defaults match
+    SpectrumExportProperties.
+    """
+    window_size: int = 1024
+    zero_extension: int = 1024
+    window_type: str = "BLACKMAN_HARRIS"
+    stereo_mode: str = "NONE"
+    output_channels: str = "MAGNITUDE_PHASE"
+    fps: float = 30
+    hist: int = 0
+    keep_dc_offset: bool = False
+    use_db: bool = True
+    minimum_db: float = -18
+    logscale: bool = True
+    logbase: int = 10
+    min_freq: float = 20
+    max_freq: float = 21050
+    decimate: bool = False
+    band_mode: str = "INTERPOLATE"
+    filterbank: str = "NONE"
+    normalize: bool = True
+    n_output: int = 2048
+    gain: float = 0
+    bassRollOff: bool = True
+    time_smoothing: bool = False
+    smoothing_mode: str = "AVERAGE"
+    attack_time: float = 0.01
+    release_time: float = 0.2
+    zero_phase: bool = False
+    boostPerOctave: float = 0
+    output_mode: str = "SEQUENCE"
+    mip_levels: int = 0
+    mip_pooling: str = "MEAN"
+    resume: bool = True
+    color_depth: str = "8"
+    compression: int = 6
+    use_cache: bool = True
+    cache_size: int = 2048
+    collect_stats: bool = False
+
+    @classmethod
+    def from_props(cls, props, preset=None):
+        """
+        Creates a plain copy of the settings from SpectrumExportProperties.
+
+        Args:
+            props (SpectrumExportProperties) The export properties.
+            preset (SpectrumExportPreset, optional) A preset of the export
+                job, its fields in PRESET_FIELDS replace the properties.
+        """
+        values = {field.name: getattr(props, field.name) for field in dataclasses.fields(cls)}
+        if preset is not None:
+            values.update({name: getattr(preset, name) for name in PRESET_FIELDS})
+        return cls(**values)
+
+
+def clean_name(name: str):
+    """
+    Replaces all characters that are not safe in filenames,
+    like bpy.path.clean_name.
+    """
+    return re.sub(r"[^A-Za-z0-9_]", "_", name)
+
+
+def sample_scale(peak: float, settings: SpectrumSettings):
+    """
+    Returns the factor of the normalization and gain. The transform is
+    linear, so the factor is applied to the spectra instead of the samples.
+
+    Args:
+        peak (float) The highest absolute sample of the audio.
+        settings (SpectrumSettings) The settings of the export.
+    """
+    scale = 10**(settings.gain/20)
+    if settings.normalize and peak is not None and peak > 1e-9:
+        # Normalize Data
+        scale /= peak
+    return scale
+
+
+class ExportStats:
+    """
+    Collects the time spent in each stage of an export, the written frames
+    and bytes. Stages may be timed from several threads, so the stage times
+    are the summed time of all threads and can exceed the elapsed time.
+
+    Args:
+        n_frames (int) The total amount of frames of the export.
+    """
+
+    def __init__(self, n_frames: int):
+        self.n_frames = n_frames
+        self.start = time.perf_counter()
+        self.times = defaultdict(float)
+        self.lock = threading.Lock()
+        self.frames_done = 0
+        self.bytes_written = 0
+
+    def add(self, stage: str, seconds: float):
+        with self.lock:
+            self.times[stage] += seconds
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Context manager adding its duration to the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def as_dict(self):
+        """
+        Returns the current state, e.g. for a JSON log.
+        """
+        elapsed = time.perf_counter() - self.start
+        fps = self.frames_done/elapsed if elapsed > 0 else 0
+        eta = (self.n_frames - self.frames_done)/fps if fps > 0 else None
+        with self.lock:
+            times = dict(self.times)
+        return {"frames": self.frames_done,
+                "total_frames": self.n_frames,
+                "elapsed_s": elapsed,
+                "fps": fps,
+                "eta_s": eta,
+                "bytes_written": self.bytes_written,
+                "stages_s": times}
+
+    def summary(self):
+        """
+        Returns the current state as short lines of text.
+        """
+        stats = self.as_dict()
+        eta = "-" if stats["eta_s"] is None else f"{stats['eta_s']:.0f} s"
+        lines = [f"{stats['fps']:.1f} fps, ETA {eta}",
+                 f"Written {stats['bytes_written']/2**20:.1f} MB"]
+        total = sum(stats["stages_s"].values())
+        for name, seconds in sorted(stats["stages_s"].items(), key=lambda item: -item[1]):
+            share = seconds/total*100 if total > 0 else 0
+            lines.append(f"{name}: {seconds:.2f} s ({share:.0f}%)")
+        return lines
+
+    def save(self, path: str):
+        """
+        Writes the state as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+# Shared stand-in for the stages if no stats are collected
+_NOT_TIMED = contextlib.nullcontext()
+
+
+def timed(stats: ExportStats, name: str):
+    """
+    Returns a context manager timing a stage, it does nothing if stats is None.
+    """
+    return _NOT_TIMED if stats is None else stats.stage(name)
+
+
+def analysis_sizes(settings: SpectrumSettings, decimation: int = 1):
+    """
+    Returns the window size and the FFT size of the decimated signal. Both
+    shrink with the samplerate, so the window spans the same time and the
+    bins have about the same spacing in Hz. The decimated FFT size is
+    rounded up to a size the FFT is fast for, which only adds zeros.
+    """
+    if decimation == 1:
+        return settings.window_size, settings.window_size + settings.zero_extension
+    window_size = max(int(round(settings.window_size/decimation)), 1)
+    n_fft = max(int(round((settings.window_size + settings.zero_extension)/decimation)), window_size)
+    return window_size, next_fast_len(n_fft)
+
+
+class FrameSource:
+    """
+    Base class for the sources calculating the raw spectra of the frames.
+    read is called in frame order by one thread at a time, spectra may be
+    called from several threads at once. The spectra can be recorded into
+    a cache entry while they are calculated.
+
+    Args:
+        samplerate (int) The samplerate of the audio.
+        n_samples (int) The length of the audio in samples.
+        peak (float) The highest absolute sample, None if unknown.
+        settings (SpectrumSettings) The settings of the export.
+        decimation (int, optional) The factor the samplerate is divided by
+            before the FFT, the windows are in decimated samples.
+        downmix (bool, optional) If true the stereo modes also transform
+            the mono mix of all channels, for files with more channels
+            than left and right.
+    """
+
+    def __init__(self, samplerate: int, n_samples: int, peak: float, settings: SpectrumSettings,
+                 decimation: int = 1, downmix: bool = False):
+        self.samplerate = samplerate
+        self.n_samples = n_samples
+        self.peak = peak
+        self.decimation = decimation
+
+        # Calculate total amount of required frames
+        self.n_frames_total = int(n_samples/samplerate*settings.fps) + 1
+        self.window_size, self.n_fft = analysis_sizes(settings, decimation)
+        self.centers = frame_centers(self.n_frames_total, settings.fps, samplerate/decimation)
+        self.window = get_window(settings.window_type, self.window_size)
+        # Threads of a single FFT call, the chunks already run in parallel
+        self.fft_workers = 1
+        # Left and right are transformed separately for the stereo modes,
+        # followed by the mono mix if it does not follow from them
+        self.downmix = downmix and STEREO_PLANES[settings.stereo_mode] > 0
+        self.n_channels = 2 + self.downmix if STEREO_PLANES[settings.stereo_mode] else 1
+        self.cache_entry = None
+
+    def shape(self):
+        """
+        Returns the shape of all raw spectra, (frames, bins) for mono and
+        (frames, channels, bins) with left, right and the optional mono mix
+        for the stereo modes.
+        """
+        if self.n_channels == 1:
+            return (self.n_frames_total, self.n_fft//2 + 1)
+        return (self.n_frames_total, self.n_channels, self.n_fft//2 + 1)
+
+    def meta(self):
+        """
+        Returns the values that are stored with the cached spectra.
+        """
+        return {"samplerate": self.samplerate, "n_samples": self.n_samples, "peak": self.peak,
+                "decimation": self.decimation}
+
+    def read(self, frame_ids):
+        """
+        Returns the samples of the given frames, one row per frame. In the
+        stereo modes every row holds the left and right samples and the
+        optional mono mix.
+        """
+        raise NotImplementedError
+
+    def spectra(self, frame_ids, frames):
+        """
+        Returns the raw spectra of the frames returned by read.
+        """
+        spectra = windowed_rfft(frames, self.n_fft, self.window, self.fft_workers)
+        if self.cache_entry is not None:
+            self.cache_entry.spectra[frame_ids] = spectra
+        return spectra
+
+    def finish(self):
+        """
+        Called after all spectra were requested.
+        """
+        if self.cache_entry is not None:
+            self.cache_entry.commit()
+            self.cache_entry = None
+
+    def discard(self):
+        """
+        Called if the export was cancelled.
+        """
+        if self.cache_entry is not None:
+            self.cache_entry.discard()
+            self.cache_entry = None
+
+
+class StreamingSource(FrameSource):
+    """
+    Calculates the raw spectra while decoding the audio blockwise. Only the
+    samples spanned by the requested frames are decoded, so the memory does
+    not depend on the length of the file. With a decimation the samples of
+    the windows are lowpass filtered and decimated right after decoding.
+
+    Args:
+        stream (AudioStream) The opened audio file.
+        settings (SpectrumSettings) The settings of the export.
+        peak (float) The highest absolute sample, None if unknown.
+        decimation (int, optional) The factor the samplerate is divided by.
+    """
+
+    def __init__(self, stream: AudioStream, settings: SpectrumSettings, peak: float, decimation: int = 1):
+        super().__init__(stream.samplerate, stream.n_samples, peak, settings, decimation,
+                         downmix=stream.channels > 2)
+        self.stream = stream
+        self.taps = decimation_filter(decimation) if decimation > 1 else None
+
+    def read(self, frame_ids):
+        # Block covering all windows of the frames, the window of center c
+        # starts at c - window_size//2
+        starts = self.centers[frame_ids] - self.window_size//2
+        lo = int(starts[0])
+        hi = int(starts[-1]) + self.window_size
+        if self.taps is not None:
+            return self._read_decimated(starts - lo, lo, hi)
+        if self.n_channels == 1:
+            block = self.stream.read(lo, hi)
+            view = np.lib.stride_tricks.sliding_window_view(block, self.window_size)
+            return view[starts - lo]
+
+        # One decode for all channels, frames become (frames, channels, samples)
+        block = self.stream.read_channels(lo, hi, 2, self.downmix)
+        view = np.lib.stride_tricks.sliding_window_view(block, self.window_size, axis=-1)
+        return view[:, starts - lo].swapaxes(0, 1)
+
+    def _read_decimated(self, starts, lo: int, hi: int):
+        # The filter of decimated sample m is centered on sample m*decimation
+        half = len(self.taps)//2
+        start = lo*self.decimation - half
+        stop = (hi - 1)*self.decimation + half + 1
+        if self.n_channels == 1:
+            block = self.stream.read(start, stop)
+            return decimate_windows(block, starts, self.window_size, self.taps, self.decimation)
+
+        block = self.stream.read_channels(start, stop, 2, self.downmix)
+        frames = decimate_windows(block, starts, self.window_size, self.taps, self.decimation)
+        return frames.swapaxes(0, 1)
+
+    def finish(self):
+        super().finish()
+        self.stream.close()
+
+    def discard(self):
+        super().discard()
+        self.stream.close()
+
+
+class CachedSource:
+    """
+    Reads the raw spectra of the frames from a cache entry.
+
+    Args:
+        spectra (np.ndarray) The memory mapped spectra.
+        meta (dict) The values stored with the spectra.
+    """
+
+    def __init__(self, spectra, meta: dict):
+        self.raw = spectra
+        self.samplerate = meta["samplerate"]
+        self.n_samples = meta["n_samples"]
+        self.peak = meta["peak"]
+        self.decimation = meta.get("decimation", 1)
+        self.n_frames_total = len(spectra)
+
+    def read(self, frame_ids):
+        # Fancy indexing copies the rows out of the memory map
+        return self.raw[frame_ids]
+
+    def spectra(self, frame_ids, spectra):
+        return spectra
+
+    def finish(self):
+        pass
+
+    def discard(self):
+        pass
+
+
+def open_source(audio_path: str, settings: SpectrumSettings, cache: SpectrumCache = None,
+                record: bool = True):
+    """
+    Returns the source of the raw spectra of an audio file. If the spectra
+    are cached the audio is neither decoded nor transformed, otherwise it is
+    decoded blockwise while the frames are computed.
+
+    Args:
+        audio_path (str) The path of the audio file.
+        settings (SpectrumSettings) The settings of the export.
+        cache (SpectrumCache, optional) The cache to read from and write to.
+        record (bool, optional) If false the calculated spectra are not
+            written to the cache, e.g. if not all frames are calculated.
+    Returns:
+        A StreamingSource or CachedSource.
+    """
+    audio_hash = None
+    peak = None
+    if cache is not None:
+        audio_hash = file_hash(audio_path)
+        key = cache_key(audio_hash, settings)
+        entry = cache.get(key)
+        if entry is not None:
+            return CachedSource(*entry)
+        peak = cache.get_peak(audio_hash)
+
+    stream = AudioStream(audio_path)
+    if peak is None and (settings.normalize or cache is not None):
+        # The normalization needs the peak before the first frame
+        peak = stream.peak()
+        if cache is not None:
+            cache.set_peak(audio_hash, peak)
+
+    decimation = 1
+    if settings.decimate and settings.logscale:
+        # Frequencies above max_freq are not shown
+        decimation = decimation_factor(stream.samplerate, settings.max_freq)
+    source = StreamingSource(stream, settings, peak, decimation)
+    # Spectra larger than the whole cache would only evict everything else
+    fits = cache is not None and np.prod(source.shape())*np.dtype(np.complex64).itemsize <= cache.max_bytes
+    if fits and record:
+        source.cache_entry = cache.create(key, source.shape(), source.meta())
+    return source
+
+
+def create_cache(settings: SpectrumSettings):
+    """
+    Returns the spectrum cache if it is enabled in the settings.
+    """
+    if not settings.use_cache:
+        return None
+    return SpectrumCache(max_bytes=settings.cache_size*2**20)
+
+
+class SpectrumAnalysis:
+    """
+    Calculates the post-processed spectra of all output frames.
+    compute_chunk can be run from several threads at once. In order, the
+    smoothing continues from the state the previous chunk left, so the
+    chunks have to pass the smoothing one at a time in frame order.
+
+    Args:
+        source (StreamingSource or CachedSource) The source of the raw spectra.
+        settings (SpectrumSettings) The settings of the export.
+        stats (ExportStats, optional) Collects the time of the stages.
+        in_order (bool, optional) Whether all chunks are computed in frame
+            order. Otherwise any frames can be computed, e.g. by the
+            preview, and the chunks are extended by the frames in front of
+            them the smoothing needs.
+    """
+
+    def __init__(self, source, settings: SpectrumSettings, stats: ExportStats = None, in_order: bool = True):
+        self.source = source
+        self.settings = settings
+        self.stats = stats
+        self.in_order = in_order
+        # The rate of the analysed, possibly decimated signal
+        self.decimation = source.decimation
+        self.samplerate = source.samplerate/self.decimation
+        self.sound_length = source.n_samples/source.samplerate
+        self.n_frames_total = source.n_frames_total
+        self.scale = sample_scale(source.peak, settings)
+
+        self.fft_offset = 0 if settings.keep_dc_offset or settings.logscale else 1
+        self.n_fft = analysis_sizes(settings, self.decimation)[1]
+        self.fft_out_width = self.n_fft//2 + (1-self.fft_offset)
+        self.final_res = self.fft_out_width if not settings.logscale else settings.n_output
+        # Channels of the pixel matrix the planes of process_spectra go to.
+        # Red holds the magnitudes, green the phases and blue and alpha the
+        # stereo magnitudes. Channels that are not requested are skipped.
+        self.use_magnitude = settings.output_channels != "PHASE"
+        self.use_phase = settings.output_channels != "MAGNITUDE"
+        self.plane_channels = ([0] if self.use_magnitude else []) \
+            + ([1] if self.use_phase else []) \
+            + [2, 3][:STEREO_PLANES[settings.stereo_mode]]
+        self.n_planes = len(self.plane_channels)
+
+        self.min_gain = 10**(settings.minimum_db/20)
+        # Scratch buffers of the post-processing, one set per worker thread
+        self.scratch = threading.local()
+        self.gain_per_octave = 10**(settings.boostPerOctave/20)
+
+        self.log_map = None
+        if settings.logscale and settings.filterbank != "NONE":
+            # Triangular filters centered on the output pixels
+            self.log_map = FilterBank(self.n_fft//2 + 1,
+                                      self.samplerate//2,
+                                      settings.min_freq,
+                                      settings.max_freq,
+                                      settings.n_output,
+                                      settings.filterbank
+                                      )
+        elif settings.logscale:
+            # Precalculate the mapping onto the log frequency scale
+            self.log_map = LogFrequencyMap(self.n_fft//2 + 1,
+                                           self.samplerate//2,
+                                           settings.min_freq,
+                                           settings.max_freq,
+                                           settings.n_output,
+                                           settings.logbase,
+                                           band_mode=settings.band_mode
+                                           )
+
+        self.temporal_filter = None
+        # The next frame to smooth and the state of the filter in front of it
+        self.smoothing_state = (0, None)
+        if settings.time_smoothing:
+            self.temporal_filter = TemporalFilter(settings.smoothing_mode,
+                                                  settings.fps,
+                                                  settings.attack_time,
+                                                  settings.release_time,
+                                                  settings.zero_phase
+                                                  )
+            if settings.smoothing_mode != "AVERAGE":
+                # Holding or enveloping the phases has no meaning
+                self.smoothed_planes = [i for i, channel in enumerate(self.plane_channels) if channel != 1]
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE):
+        """
+        Returns the frame indices of each chunk.
+        """
+        if self.temporal_filter is not None:
+            # Keep the frames around the chunks a small part of the work
+            before, after = self.padding()
+            chunk_size = max(chunk_size, SMOOTHING_CHUNK_RATIO*(before + after))
+        return [np.arange(start, min(start + chunk_size, self.n_frames_total))
+                for start in range(0, self.n_frames_total, chunk_size)]
+
+    def padded(self, frame_ids):
+        """
+        Returns all frames from the first to the last of the given frames
+        and the frames around them the temporal filter needs.
+        """
+        before, after = self.padding()
+        return np.arange(max(frame_ids[0] - before, 0), min(frame_ids[-1] + 1 + after, self.n_frames_total))
+
+    def padding(self):
+        """
+        Returns the number of frames the smoothing needs in front of and
+        behind a chunk.
+        """
+        if self.temporal_filter is None:
+            return 0, 0
+        if self.in_order:
+            # The state of the previous chunk replaces the frames in front
+            return 0, self.temporal_filter.after
+        return self.temporal_filter.before, self.temporal_filter.after
+
+    def read(self, frame_ids):
+        """
+        Reads the input of the given frames, has to be called in frame order.
+        """
+        with timed(self.stats, "read"):
+            return self.source.read(self.padded(frame_ids))
+
+    def compute_chunk(self, frame_ids, frames, turn=None):
+        """
+        Calculates and post-processes the spectra of the given frames.
+
+        Args:
+            frame_ids (np.ndarray) The zero based indices of the frames in
+                ascending order.
+            frames (np.ndarray) The input of the frames returned by read.
+            turn (context manager, optional) Entered around the smoothing,
+                see TurnOrder. Not needed if only one thread computes the
+                chunks.
+        Returns:
+            The pixel planes of shape (frames, n_planes, width), see
+            process_spectra.
+        """
+        padded_ids = self.padded(frame_ids)
+        with timed(self.stats, "fft"):
+            spectra = self.source.spectra(padded_ids, frames)
+        pixels = self.process_chunk(spectra)
+        with turn or contextlib.nullcontext():
+            return self.smooth_chunk(frame_ids, padded_ids, pixels)
+
+    def process_chunk(self, spectra):
+        """
+        Post-processes the raw spectra of a chunk, the spectra are modified.
+
+        Args:
+            spectra (np.ndarray) The raw spectra of the padded frames.
+        Returns:
+            The pixel planes of shape (frames, n_planes, width).
+        """
+        with timed(self.stats, "postprocess"):
+            spectra *= self.scale
+            if spectra.ndim == 2:
+                pixels = self.process_spectra(spectra)
+            else:
+                # The transform is linear, so mid and side follow from left
+                # and right. Files with more channels bring their own mono mix.
+                left, right = spectra[:, 0], spectra[:, 1]
+                mono = spectra[:, 2] if spectra.shape[1] > 2 else (left + right)/2
+                if self.settings.stereo_mode == "SIDE":
+                    pixels = self.process_spectra(mono, [(left - right)/2])
+                else:
+                    pixels = self.process_spectra(mono, [left, right])
+        return pixels
+
+    def smooth_chunk(self, frame_ids, padded_ids, pixels):
+        """
+        Smoothes the pixel planes of a chunk over time, the planes are
+        modified. In order, the chunks have to be passed in frame order.
+
+        Args:
+            frame_ids (np.ndarray) The zero based indices of the frames in
+                ascending order.
+            padded_ids (np.ndarray) The frames of the pixel planes, see padded.
+            pixels (np.ndarray) The pixel planes of the padded frames.
+        Returns:
+            The pixel planes of the given frames.
+        """
+        if self.temporal_filter is not None:
+            with timed(self.stats, "smooth"):
+                state = None
+                if self.in_order:
+                    next_frame, state = self.smoothing_state
+                    if padded_ids[0] != next_frame:
+                        raise ValueError("The chunks of the smoothing are not in frame order")
+                # The state follows the last frame of the chunk, the rest is lookahead
+                n_frames = frame_ids[-1] + 1 - padded_ids[0]
+                if self.settings.smoothing_mode == "AVERAGE":
+                    state = self.temporal_filter(pixels, state, n_frames)
+                elif self.smoothed_planes:
+                    planes = pixels[:, self.smoothed_planes]
+                    state = self.temporal_filter(planes, state, n_frames)
+                    pixels[:, self.smoothed_planes] = planes
+                if self.in_order:
+                    self.smoothing_state = (frame_ids[-1] + 1, state)
+        if len(padded_ids) == len(frame_ids):
+            return pixels
+        return pixels[frame_ids - padded_ids[0]]
+
+    def finish(self):
+        """
+        Called after all frames were computed, commits the cache entry.
+        """
+        self.source.finish()
+
+    def discard(self):
+        """
+        Called if the export was cancelled.
+        """
+        self.source.discard()
+
+    def process_spectra(self, spectra, extra=()):
+        """
+        Converts a batch of spectra to the pixel planes of the output. Every
+        row is one frame. The planes hold the magnitudes and the phases of
+        the spectra, if requested by the output channels, followed by the
+        magnitudes of the extra spectra, see plane_channels.
+
+        Args:
+            spectra (np.ndarray) The spectra of the frames, one per row.
+            extra (list, optional) Further spectra of the same frames, only
+                their magnitudes are kept.
+        Returns:
+            An array of shape (frames, n_planes, width).
+        """
+        settings = self.settings
+        n_frames, n_bins = spectra.shape
+        planes = []
+        magnitudes = ([spectra] if self.use_magnitude else []) + list(extra)
+        if magnitudes:
+            planes.extend(self._process_magnitudes(magnitudes))
+        if self.use_phase:
+            phases = self._scratch("phases", (n_frames, n_bins))
+            np.arctan2(spectra.imag, spectra.real, out=phases)
+            phases *= 1/(2*np.pi)
+            if settings.logscale:
+                phases = self.log_map(phases, interpolate_only=True)
+            # Green follows red
+            planes.insert(1 if self.use_magnitude else 0, phases)
+        return np.stack(planes, axis=1).astype(np.float32, copy=False)
+
+    def _process_magnitudes(self, spectra):
+        """
+        Applies the boost, dB, frequency scale and rolloff to the magnitudes
+        of the spectra.
+
+        Returns:
+            An array of shape (len(spectra), frames, width).
+        """
+        settings = self.settings
+        n_frames, n_bins = spectra[0].shape
+        # All magnitudes are post-processed together in place in a reused
+        # buffer, shape (planes, frames, bins)
+        freqs = self._scratch("freqs", (len(spectra), n_frames, n_bins))
+        for plane, values in zip(freqs, spectra):
+            np.abs(values, out=plane)
+
+        nyquist = self.samplerate//2
+        if np.abs(settings.boostPerOctave) > 1e-2:
+            # Apply boost
+            freqs *= get_boost_curve(self.gain_per_octave,
+                                     freqs.shape[-1],
+                                     nyquist,
+                                     dtype=freqs.dtype
+                                     )
+
+        if settings.use_db:
+            # Convert Data to db, everything below min_db becomes min_db
+            np.maximum(freqs, self.min_gain, out=freqs)
+            np.log10(freqs, out=freqs)
+
+            # Rescale from min_db-0 to 0-1, (20*log10(x) - min_db)/-min_db
+            freqs *= 20/-settings.minimum_db
+            freqs += 1
+            np.maximum(freqs, 0, out=freqs)
+
+        if settings.logscale:
+            # Map the bins onto the precalculated log positions
+            freqs = self.log_map(freqs)
+
+        if settings.bassRollOff:
+            # Apply rolloff
+            rolloffLen = int(self.final_res*.08)
+            if rolloffLen > 0:
+                freqs[..., 0:rolloffLen] *= get_rolloff_curve(rolloffLen, dtype=freqs.dtype)
+        return freqs
+
+    def _scratch(self, name: str, shape):
+        """
+        Returns a float32 buffer of the given shape that is reused by the
+        calling thread. The content is undefined.
+        """
+        buffers = self.scratch.__dict__
+        size = int(np.prod(shape))
+        buffer = buffers.get(name)
+        if buffer is None or len(buffer) < size:
+            buffer = buffers[name] = np.empty(size, dtype=np.float32)
+        return buffer[:size].reshape(shape)
+
+
+class SharedAnalysis:
+    """
+    Runs several analyses of the same source, e.g. the presets of an
+    export job. The input of every chunk is read and transformed only once
+    and then post-processed by each analysis. It is used like a
+    SpectrumAnalysis, but compute_chunk returns a tuple with the pixel
+    planes of every analysis per frame.
+
+    Args:
+        analyses (list) SpectrumAnalysis objects that share their source.
+    """
+
+    def __init__(self, analyses: list):
+        self.analyses = analyses
+        self.source = analyses[0].source
+        self.stats = analyses[0].stats
+        self.n_frames_total = self.source.n_frames_total
+
+    def chunks(self, chunk_size: int = CHUNK_SIZE):
+        """
+        Returns the frame indices of each chunk, the chunks are as large
+        as the largest chunks of the analyses.
+        """
+        return max((analysis.chunks(chunk_size) for analysis in self.analyses), key=lambda chunks: len(chunks[0]))
+
+    def padded(self, frame_ids):
+        """
+        Returns the frames any of the analyses needs for the given frames.
+        """
+        padded = [analysis.padded(frame_ids) for analysis in self.analyses]
+        return np.arange(min(ids[0] for ids in padded), max(ids[-1] for ids in padded) + 1)
+
+    def read(self, frame_ids):
+        """
+        Reads the input of the given frames, has to be called in frame order.
+        """
+        with timed(self.stats, "read"):
+            return self.source.read(self.padded(frame_ids))
+
+    def compute_chunk(self, frame_ids, frames, turn=None):
+        """
+        Calculates the raw spectra of the given frames and post-processes
+        them with every analysis.
+
+        Args:
+            frame_ids (np.ndarray) The zero based indices of the frames in
+                ascending order.
+            frames (np.ndarray) The input of the frames returned by read.
+            turn (context manager, optional) Entered around the smoothing,
+                see SpectrumAnalysis.compute_chunk.
+        Returns:
+            A list with a tuple of the pixel planes of every analysis per frame.
+        """
+        padded_ids = self.padded(frame_ids)
+        with timed(self.stats, "fft"):
+            spectra = self.source.spectra(padded_ids, frames)
+
+        processed = []
+        for i, analysis in enumerate(self.analyses):
+            own_ids = analysis.padded(frame_ids)
+            own = spectra[own_ids[0] - padded_ids[0]:own_ids[-1] + 1 - padded_ids[0]]
+            if i < len(self.analyses) - 1:
+                # The post-processing works in place, the last one may keep the spectra
+                own = own.copy()
+            processed.append((analysis, own_ids, analysis.process_chunk(own)))
+        with turn or contextlib.nullcontext():
+            results = [analysis.smooth_chunk(frame_ids, own_ids, pixels) for analysis, own_ids, pixels in processed]
+        return list(zip(*results))
+
+    def finish(self):
+        self.source.finish()
+
+    def discard(self):
+        self.source.discard()
+
+
+class TurnOrder:
+    """
+    Lets tasks on several threads pass a section one at a time in the
+    order of their indices. Every index has to pass, see done. Tasks of an
+    executor are started in the order they were submitted, so the earlier
+    indices are always running or finished and waiting cannot deadlock.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.next = 0
+
+    @contextlib.contextmanager
+    def turn(self, index: int):
+        """
+        Context manager that waits for the previous indices, ends the turn
+        on exit.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.next == index)
+        try:
+            yield
+        finally:
+            self.done(index)
+
+    def done(self, index: int):
+        """
+        Ends the turn of an index without entering the section, does
+        nothing if the turn already ended.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.next >= index)
+            if self.next == index:
+                self.next += 1
+                self.condition.notify_all()
+
+
+class SpectrumWorkers:
+    """
+    Runs SpectrumAnalysis.read and compute_chunk for all chunks on a thread
+    pool. The FFT releases the GIL, so the threads scale with the cores.
+    The input is read by the tasks in chunk order, so neither decoding nor
+    computing runs on the thread consuming the chunks. Only a bounded
+    amount of chunks is in flight to limit the memory of finished but not
+    yet consumed chunks. The chunks also pass the smoothing in order, see
+    SpectrumAnalysis.
+
+    Args:
+        analysis (SpectrumAnalysis) The analysis to run.
+        n_workers (int, optional) Number of threads, defaults to the cores.
+    """
+
+    def __init__(self, analysis: SpectrumAnalysis, n_workers: int = None):
+        self.analysis = analysis
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        self.stop_event = threading.Event()
+        self.chunks = deque(analysis.chunks())
+        self.n_submitted = 0
+        # The source is read by one task at a time in frame order, the lock
+        # lets shutdown wait for a running read
+        self.reads = TurnOrder()
+        self.read_lock = threading.Lock()
+        self.smoothing = TurnOrder()
+        # Chunks of the smoothing can be long, so the frames in flight are
+        # bounded as well. One chunk is always allowed.
+        self.pending = deque()
+        self.pending_frames = 0
+        longest = len(analysis.padded(self.chunks[0])) if self.chunks else 0
+        self.max_frames = max(2*self.n_workers*CHUNK_SIZE, 2*longest)
+        self.submit()
+
+    def _run(self, index: int, frame_ids):
+        try:
+            with self.reads.turn(index), self.read_lock:
+                if self.stop_event.is_set():
+                    return None
+                frames = self.analysis.read(frame_ids)
+            return frame_ids, self.analysis.compute_chunk(frame_ids, frames, self.smoothing.turn(index))
+        finally:
+            # The later chunks wait for this one even if it never got its turn
+            self.smoothing.done(index)
+
+    def submit(self):
+        """
+        Submits chunks until enough are in flight.
+        """
+        while len(self.pending) < 2*self.n_workers and self.chunks:
+            n_frames = len(self.analysis.padded(self.chunks[0]))
+            if self.pending and self.pending_frames + n_frames > self.max_frames:
+                break
+            frame_ids = self.chunks.popleft()
+            self.pending.append((self.executor.submit(self._run, self.n_submitted, frame_ids), n_frames))
+            self.pending_frames += n_frames
+            self.n_submitted += 1
+
+    def finished(self):
+        """
+        True if all chunks were consumed.
+        """
+        return not self.pending and not self.chunks
+
+    def ready(self):
+        """
+        True if the next chunk in order is available.
+        """
+        return bool(self.pending) and self.pending[0][0].done()
+
+    def pop(self):
+        """
+        Returns the next chunk in order, waits for it if necessary.
+
+        Returns:
+            A tuple of the frame indices and the pixel planes of the frames.
+        """
+        future, n_frames = self.pending.popleft()
+        self.pending_frames -= n_frames
+        frame_ids, pixels = future.result()
+        self.submit()
+        return frame_ids, pixels
+
+    def __iter__(self):
+        while not self.finished():
+            yield self.pop()
+
+    def shutdown(self):
+        """
+        Stops the workers. Chunks that have not started are dropped, a
+        running read is finished, so the source can be closed afterwards.
+        """
+        self.stop_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.read_lock:
+            pass
+        self.pending.clear()
+        self.pending_frames = 0
+        self.chunks.clear()
+
+
+class FrameAssembler:
+    """
+    The sequential part of the export. Keeps the history and builds the
+    pixel matrix of each frame.
+
+    The history is a ring buffer that is stored twice in a row. Every new
+    row is written to both copies, so the hist+1 newest rows are always a
+    contiguous slice in the right order and nothing has to be shifted.
+
+    Args:
+        analysis (SpectrumAnalysis) The analysis the frames come from.
+        level (int, optional) The mip level, above 0 the bands of the full
+            width are pooled into a narrower matrix, see mip_width. The
+            phases are decimated instead, pooling wrapped phases has no
+            meaning.
+    """
+
+    def __init__(self, analysis: SpectrumAnalysis, level: int = 0):
+        settings = analysis.settings
+        self.settings = settings
+        self.fft_offset = analysis.fft_offset
+        self.level = level
+        self.width = mip_width(analysis.final_res, level)
+
+        # Allocate the doubled ring buffer of the pixel matrix
+        self.n_rows = settings.hist+1
+        self.ring = np.zeros((2*self.n_rows, self.width, 4),
+                             dtype=np.float32
+                             )
+        self.head = 0
+
+        # Channels of the planes, a slice if they are consecutive
+        channels = analysis.plane_channels
+        if channels == list(range(channels[0], channels[0] + len(channels))):
+            channels = slice(channels[0], channels[0] + len(channels))
+        self.channels = channels
+        self.phase_plane = analysis.plane_channels.index(1) if 1 in analysis.plane_channels else None
+
+    def add(self, pixels):
+        """
+        Adds the next frame. The returned pixel matrix is reused, so it has
+        to be written before the next frame is added.
+
+        Args:
+            pixels (np.ndarray) The pixel planes of the frame created by
+                SpectrumAnalysis.process_spectra.
+        Returns:
+            The pixel matrix of shape (hist+1, width, 4).
+        """
+        # The newest row is in front of the previous ones
+        self.head = (self.head - 1) % self.n_rows
+        row = self.ring[self.head]
+        planes = pixels[:, self.fft_offset:]
+        if self.level:
+            factor = MIP_FACTOR**self.level
+            pooled = pool_width(planes, factor, self.settings.mip_pooling)
+            if self.phase_plane is not None:
+                pooled[self.phase_plane] = planes[self.phase_plane, ::factor]
+            planes = pooled
+
+        # Save spectrum data in red, phase data in green and the
+        # stereo magnitudes in blue and alpha
+        row[:, self.channels] = planes.T
+
+        # Mirror into the second copy
+        self.ring[self.head + self.n_rows] = row
+
+        return self.ring[self.head:self.head + self.n_rows]
+
+
+class FrameScheduler:
+    """
+    Hands the computed frames of the workers to the sequential part of the
+    export within a time budget, so the interactive export neither blocks
+    the UI nor idles between the timer events. The cost of a frame is
+    measured while the frames are consumed, a frame is only started if it
+    likely fits into the remaining budget.
+
+    Args:
+        workers (SpectrumWorkers) The workers computing the frames.
+        budget (float) Seconds of work per call of take.
+        block (bool, optional) If true take waits for frames that are still
+            being computed instead of returning early.
+    """
+
+    def __init__(self, workers: SpectrumWorkers, budget: float, block: bool = False):
+        self.workers = workers
+        self.budget = budget
+        self.block = block
+        self.frames = deque()
+        # Moving average of the seconds per frame
+        self.frame_cost = None
+
+    def finished(self):
+        """
+        True if all frames were taken.
+        """
+        return not self.frames and self.workers.finished()
+
+    def take(self):
+        """
+        Yields the next frames in order as tuples of the frame index and the
+        pixel planes until the budget is used up or no frame is ready.
+        """
+        start = time.perf_counter()
+        n_taken = 0
+        while True:
+            if not self.frames:
+                if self.workers.finished() or not (self.block or self.workers.ready()):
+                    return
+                frame_ids, pixels_batch = self.workers.pop()
+                self.frames.extend(zip(frame_ids, pixels_batch))
+
+            # At least one frame per call, even if it exceeds the budget
+            frame_start = time.perf_counter()
+            if n_taken and frame_start - start + self.frame_cost > self.budget:
+                return
+            yield self.frames.popleft()
+            n_taken += 1
+
+            cost = time.perf_counter() - frame_start
+            self.frame_cost = cost if self.frame_cost is None else 0.8*self.frame_cost + 0.2*cost
+
+
+def write_frames(frames, assembler: FrameAssembler, writer, stats: ExportStats = None):
+    """
+    Assembles and writes frames, has to be called in frame order.
+
+    Args:
+        frames (iterable) Tuples of the zero based frame index and the pixel
+            planes of the frame.
+        assembler (FrameAssembler) Keeps the history of the export.
+        writer (FrameWriter) Writes the pixel matrices.
+        stats (ExportStats, optional) Collects the time of the stages.
+    Returns:
+        The index of the last written frame, None if there was no frame.
+    """
+    frame_id = None
+    if stats is None:
+        for frame_id, pixels in frames:
+            writer.write(frame_id, assembler.add(pixels))
+        return frame_id
+
+    for frame_id, pixels in frames:
+        with stats.stage("assemble"):
+            img = assembler.add(pixels)
+        with stats.stage("write"):
+            writer.write(frame_id, img)
+        stats.frames_done += 1
+    stats.bytes_written = writer.bytes_written
+    return frame_id
+
+
+class SpectrumPreview:
+    """
+    Calculates single frames of the export on demand, e.g. the frame shown
+    in blender. The pixel planes of recent frames are kept in a least
+    recently used cache and the frames after the requested one are
+    calculated ahead on a background thread, so stepping through the
+    frames only calculates the new ones.
+
+    The history of a frame depends on the frames before it, they are
+    replayed from the cached planes with a fresh FrameAssembler.
+
+    Args:
+        audio_path (str) The path of the audio file.
+        settings (SpectrumSettings) The settings of the export.
+        cache_frames (int, optional) Number of frames kept in memory.
+        prefetch (int, optional) Number of frames calculated ahead.
+    """
+
+    def __init__(self, audio_path: str, settings: SpectrumSettings,
+                 cache_frames: int = PREVIEW_CACHE_FRAMES, prefetch: int = PREVIEW_PREFETCH):
+        self.audio_path = audio_path
+        self.settings = settings
+        # Cached spectra are used, but the few calculated frames are not recorded
+        self.source = open_source(audio_path, settings, create_cache(settings), record=False)
+        self.n_frames_total = self.source.n_frames_total
+        self.prefetch = prefetch
+        self.min_cache_frames = cache_frames
+        self.planes = OrderedDict()
+
+        # The source is only read from one thread at a time
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.closed = False
+        self._set_analysis(settings)
+
+    def _set_analysis(self, settings: SpectrumSettings):
+        self.analysis = SpectrumAnalysis(self.source, settings, in_order=False)
+        self.settings = settings
+        # Frames replayed before the requested one
+        self.n_context = settings.hist
+        # The replayed and prefetched frames have to fit
+        self.cache_frames = max(self.min_cache_frames, self.n_context + 1 + self.prefetch)
+        self.planes.clear()
+
+    def is_current(self, audio_path: str, settings: SpectrumSettings):
+        """
+        True if the preview was created for the audio file and the settings,
+        settings that only change the output files are ignored.
+        """
+        ignored = {name: None for name in OUTPUT_FIELDS}
+        return audio_path == self.audio_path and \
+            dataclasses.replace(settings, **ignored) == dataclasses.replace(self.settings, **ignored)
+
+    def shares_source(self, audio_path: str, settings: SpectrumSettings):
+        """
+        True if the raw spectra of the preview can be used for the audio
+        file and the settings, see set_settings.
+        """
+        return audio_path == self.audio_path and \
+            cache_key("", settings) == cache_key("", self.settings) and \
+            (self.source.peak is not None or not settings.normalize)
+
+    def set_settings(self, settings: SpectrumSettings):
+        """
+        Replaces the settings of the post-processing, the source and the
+        background thread are kept, but the cached frames are dropped.
+
+        Args:
+            settings (SpectrumSettings) The new settings, shares_source has
+                to be true for them.
+        """
+        with self.lock:
+            self._set_analysis(settings)
+
+    def _compute(self, frame_ids):
+        """
+        Calculates the frames that are not cached, has to hold the lock.
+        """
+        missing = np.array([i for i in frame_ids if i not in self.planes], dtype=int)
+        if len(missing):
+            pixels = self.analysis.compute_chunk(missing, self.analysis.read(missing))
+            self.planes.update(zip(missing.tolist(), pixels))
+        for frame_id in frame_ids:
+            self.planes.move_to_end(frame_id)
+        while len(self.planes) > self.cache_frames:
+            self.planes.popitem(last=False)
+
+    def _prefetch(self, frame_ids):
+        with self.lock:
+            if not self.closed:
+                self._compute(frame_ids)
+
+    def frame(self, frame_id: int):
+        """
+        Returns the pixel matrix of a frame, like FrameAssembler.add it has
+        the shape (hist+1, final_res, 4).
+
+        Args:
+            frame_id (int) The zero based index of the frame, it is clipped
+                to the frames of the audio.
+        """
+        frame_id = min(max(frame_id, 0), self.n_frames_total - 1)
+        frame_ids = range(max(frame_id - self.n_context, 0), frame_id + 1)
+        with self.lock:
+            self._compute(frame_ids)
+            planes = [self.planes[i] for i in frame_ids]
+
+        assembler = FrameAssembler(self.analysis)
+        for pixels in planes:
+            img = assembler.add(pixels)
+
+        if self.pending is None or self.pending.done():
+            ahead = range(frame_id + 1, min(frame_id + 1 + self.prefetch, self.n_frames_total))
+            if len(ahead):
+                self.pending = self.executor.submit(self._prefetch, ahead)
+        return img
+
+    def close(self):
+        """
+        Stops the prefetching and closes the audio file.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.closed = True
+            self.planes.clear()
+            self.analysis.discard()
+
+
+def sequence_prefix(out_dir: str, name: str):
+    """
+    Returns the path of the image sequence without frame number and extension.
+    """
+    return f"{out_dir}/{name}_"
+
+
+def stats_path(out_dir: str, name: str):
+    """
+    Returns the path of the JSON log of the export stats.
+    """
+    return f"{out_dir}/{name}_stats.json"
+
+
+def number_format(n_frames: int):
+    """
+    Returns the format string for the frame numbers with enough digits
+    for all frames.
+    """
+    # Calculate amount of digits needed to represent all framenumbers
+    n_digits = int(np.floor(np.log10(n_frames))) + 1
+    return "{0:0"+str(n_digits)+"d}"
+
+
+def image_channels(settings: SpectrumSettings):
+    """
+    Returns the channels of the pixel matrix written to the PNG output. A
+    single channel is written as grayscale, the alpha channel is only
+    written if it holds data.
+    """
+    n_stereo = STEREO_PLANES[settings.stereo_mode]
+    if n_stereo == 0 and settings.output_channels == "MAGNITUDE":
+        return (0,)
+    if n_stereo == 0 and settings.output_channels == "PHASE":
+        return (1,)
+    return (0, 1, 2, 3) if n_stereo > 1 else (0, 1, 2)
+
+
+def create_writer(settings: SpectrumSettings, analysis: SpectrumAnalysis, out_dir: str,
+                  name: str, n_processes: int = None, executor=None, level: int = 0):
+    """
+    Creates the frame writer for the output mode of the export.
+
+    Args:
+        settings (SpectrumSettings) The settings of the export.
+        analysis (SpectrumAnalysis) The analysis the frames come from.
+        out_dir (str) The directory the output is written to.
+        name (str) The name of the output.
+        n_processes (int, optional) Number of processes encoding the images
+            of a sequence, 0 to encode in the calling thread. Defaults to
+            the cores.
+        executor (concurrent.futures.Executor, optional) An executor shared
+            with other writers that encodes the images instead of an own
+            process pool. It is not shut down by the writer.
+        level (int, optional) The mip level of the output, see mip_width.
+    Returns:
+        A FrameWriter.
+    """
+    width = mip_width(analysis.final_res, level)
+    if settings.output_mode == "ATLAS":
+        return AtlasPngWriter(f"{out_dir}/{name}_atlas.png",
+                              analysis.n_frames_total,
+                              width,
+                              color_depth=int(settings.color_depth),
+                              compression=settings.compression,
+                              channels=image_channels(settings))
+
+    if settings.output_mode == "NPY":
+        # All four channels unless channels are left out on purpose
+        channels = (0, 1, 2, 3)
+        if settings.output_channels != "MAGNITUDE_PHASE":
+            channels = analysis.plane_channels
+        return NpyWriter(f"{out_dir}/{name}.npy",
+                         analysis.n_frames_total,
+                         width,
+                         channels=channels)
+
+    numbers = number_format(analysis.n_frames_total)
+    manifest = None
+    if settings.resume:
+        # Settings that change the files but not the checked pixels
+        manifest = FrameManifest(f"{out_dir}/{name}_manifest.json",
+                                 {"color_depth": settings.color_depth,
+                                  "compression": settings.compression,
+                                  "channels": list(image_channels(settings)),
+                                  "number_format": numbers})
+
+    owns_executor = executor is None
+    if owns_executor and n_processes != 0:
+        executor = encoding_pool(n_processes)
+    return PngWriter(sequence_prefix(out_dir, name),
+                     numbers,
+                     color_depth=int(settings.color_depth),
+                     compression=settings.compression,
+                     executor=executor,
+                     owns_executor=owns_executor,
+                     channels=image_channels(settings),
+                     manifest=manifest)
+
+
+def encoding_pool(n_processes: int = None):
+    """
+    Returns a process pool for encoding images.
+    """
+    # Spawn instead of fork, the parent runs threads and may be blender
+    return ProcessPoolExecutor(max_workers=n_processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+def group_presets(presets: list):
+    """
+    Groups the presets of an export job by their raw spectra, see cache_key.
+
+    Args:
+        presets (list) Tuples of the output name and the SpectrumSettings.
+    Returns:
+        A list of lists of presets in the order of their first occurrence.
+    """
+    groups = {}
+    for name, settings in presets:
+        groups.setdefault(cache_key("", settings), []).append((name, settings))
+    return list(groups.values())
+
+
+class PresetGroup:
+    """
+    The presets of an export job that share their source. Every preset
+    has one output per mip level, the outputs of the smaller levels are
+    named <name>_mip<level>.
+
+    Attributes:
+        analysis (SharedAnalysis) The analysis of all presets.
+        names (list) The name of each output.
+        settings (list) The settings of the preset of each output.
+        presets (list) The index of the preset of each output.
+        assemblers (list) The FrameAssembler of each output.
+        writers (list) The writer of each output.
+
+    Args:
+        audio_path (str) The path of the audio file.
+        presets (list) Tuples of the output name and the SpectrumSettings.
+        out_dir (str) The directory the outputs are written to.
+        stats (ExportStats, optional) Collects the time of the stages.
+        executor (concurrent.futures.Executor, optional) The executor
+            encoding the images of sequences.
+    """
+
+    def __init__(self, audio_path: str, presets: list, out_dir: str, stats: ExportStats = None, executor=None):
+        # One preset that normalizes needs the peak
+        source_settings = dataclasses.replace(presets[0][1],
+                                              normalize=any(settings.normalize for _, settings in presets))
+        source = open_source(audio_path, source_settings, create_cache(source_settings))
+        self.analysis = SharedAnalysis([SpectrumAnalysis(source, settings, stats) for _, settings in presets])
+
+        self.names = []
+        self.settings = []
+        self.presets = []
+        self.assemblers = []
+        self.writers = []
+        try:
+            for i, ((name, settings), analysis) in enumerate(zip(presets, self.analysis.analyses)):
+                for level in range(settings.mip_levels + 1):
+                    level_name = f"{name}_mip{level}" if level else name
+                    self.names.append(level_name)
+                    self.settings.append(settings)
+                    self.presets.append(i)
+                    self.assemblers.append(FrameAssembler(analysis, level))
+                    self.writers.append(create_writer(settings, analysis, out_dir, level_name, n_processes=0,
+                                                      executor=executor, level=level))
+        except BaseException:
+            self.cancel()
+            raise
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+        self.analysis.finish()
+
+    def cancel(self):
+        for writer in self.writers:
+            writer.cancel()
+        self.analysis.discard()
+
+
+class ExportJob:
+    """
+    Exports several presets of one audio file. Presets with the same raw
+    spectra form a group, the audio of a group is decoded and transformed
+    only once. The groups are exported one after another, the current
+    group takes the frames of its SharedAnalysis through add and write, so
+    the job is used as assembler and writer of write_frames.
+
+    Args:
+        audio_path (str) The path of the audio file.
+        presets (list) Tuples of the output name and the SpectrumSettings.
+        out_dir (str) The directory the outputs are written to.
+        n_processes (int, optional) Number of processes encoding the images
+            of sequences, 0 to encode in the calling thread. Defaults to
+            the cores.
+        stats (ExportStats, optional) Collects the time of the stages.
+    """
+
+    def __init__(self, audio_path: str, presets: list, out_dir: str, n_processes: int = None,
+                 stats: ExportStats = None):
+        names = [name for name, _ in presets]
+        if len(set(names)) < len(names):
+            raise ValueError(f"The output names of the presets are not unique: {names}")
+        self.stats = stats
+        self.executor = None
+        if n_processes != 0 and any(settings.output_mode == "SEQUENCE" for _, settings in presets):
+            # One pool for all sequences
+            self.executor = encoding_pool(n_processes)
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.groups = []
+        self.current = 0
+        try:
+            for group in group_presets(presets):
+                self.groups.append(PresetGroup(audio_path, group, out_dir, stats, self.executor))
+        except BaseException:
+            self.cancel()
+            raise
+        self.n_frames_total = sum(group.analysis.n_frames_total for group in self.groups)
+
+    @property
+    def group(self):
+        """
+        The group that is being exported, None after the last group.
+        """
+        return self.groups[self.current] if self.current < len(self.groups) else None
+
+    @property
+    def bytes_written(self):
+        return sum(writer.bytes_written for group in self.groups for writer in group.writers)
+
+    def add(self, pixels):
+        """
+        Adds the pixel planes of every preset of the current group, see
+        FrameAssembler.add.
+
+        Returns:
+            A list with the pixel matrix of every output of the group.
+        """
+        group = self.group
+        return [assembler.add(pixels[i]) for i, assembler in zip(group.presets, group.assemblers)]
+
+    def write(self, frame_id: int, imgs):
+        for writer, img in zip(self.group.writers, imgs):
+            writer.write(frame_id, img)
+
+    def finish_group(self):
+        """
+        Closes the outputs of the current group and continues with the next.
+
+        Returns:
+            The finished PresetGroup.
+        """
+        group = self.group
+        with timed(self.stats, "write"):
+            group.close()
+        self.current += 1
+        if self.group is None and self.executor is not None:
+            self.executor.shutdown()
+        return group
+
+    def cancel(self):
+        for group in self.groups[self.current:]:
+            group.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def export_spectrum(audio_path: str, out_dir: str, name: str = None,
+                    n_workers: int = None, n_processes: int = None, progress=None, **settings):
+    """
+    Exports the spectrum of an audio file as fast as possible.
+
+    Args:
+        audio_path (str) The path of the audio file.
+        out_dir (str) The directory the sequence is written to.
+        name (str, optional) The name of the sequence, generated from the
+            audio filename if not given.
+        n_workers (int, optional) Number of threads, defaults to the cores.
+        n_processes (int, optional) Number of processes encoding the images,
+            0 to encode in the calling thread. Defaults to the cores.
+        progress (callable, optional) Called with the number of written
+            frames and the total amount of frames.
+        settings Values for the fields of SpectrumSettings.
+    Returns:
+        The path of the first image of the sequence or of the single output file.
+    """
+    if name is None:
+        name = clean_name(os.path.basename(audio_path)) + "_fft"
+    paths = export_presets(audio_path, out_dir, [(name, SpectrumSettings(**settings))], name,
+                           n_workers, n_processes, progress)
+    return paths[name]
+
+
+def export_presets(audio_path: str, out_dir: str, presets: list, name: str,
+                   n_workers: int = None, n_processes: int = None, progress=None):
+    """
+    Exports several presets of an audio file as one job, presets that only
+    differ in the post-processing share the decoding and the FFT.
+
+    Args:
+        audio_path (str) The path of the audio file.
+        out_dir (str) The directory the outputs are written to.
+        presets (list) Tuples of the output name and the SpectrumSettings.
+        name (str) The name of the job, the timings are saved under it.
+        n_workers (int, optional) Number of threads, defaults to the cores.
+        n_processes (int, optional) Number of processes encoding the images,
+            0 to encode in the calling thread. Defaults to the cores.
+        progress (callable, optional) Called with the number of written
+            frames of all groups and the total amount of frames.
+    Returns:
+        A dict mapping the output names to the path of the first image of
+        the sequence or of the single output file.
+    """
+    stats = None
+    if any(settings.collect_stats for _, settings in presets):
+        stats = ExportStats(0)
+    job = ExportJob(audio_path, presets, out_dir, n_processes, stats)
+    if stats is not None:
+        stats.n_frames = job.n_frames_total
+
+    paths = {}
+    n_done = 0
+    try:
+        while job.group is not None:
+            workers = SpectrumWorkers(job.group.analysis, n_workers)
+            try:
+                for frame_ids, pixels_batch in workers:
+                    write_frames(zip(frame_ids, pixels_batch), job, job, stats)
+                    if progress is not None:
+                        progress(n_done + frame_ids[-1] + 1, job.n_frames_total)
+            finally:
+                workers.shutdown()
+            group = job.finish_group()
+            n_done += group.analysis.n_frames_total
+            paths.update((name, writer.first_path()) for name, writer in zip(group.names, group.writers))
+        if stats is not None:
+            stats.bytes_written = job.bytes_written
+            stats.save(stats_path(out_dir, name))
+    except BaseException:
+        job.cancel()
+        raise
+    return paths
+
+
+def _export_file(args):
+    audio_path, out_dir, settings = args
+    # The files are already processed in parallel
+    return export_spectrum(audio_path, out_dir, n_workers=1, n_processes=0, **settings)
+
+
+def export_directory(in_dir: str, out_dir: str, n_processes: int = None, **settings):
+    """
+    Exports the spectra of all audio files in a directory on a process pool.
+    Every file gets its own sequence in out_dir.
+
+    Args:
+        in_dir (str) The directory with the audio files.
+        out_dir (str) The directory the sequences are written to.
+        n_processes (int, optional) Number of processes, defaults to the cores.
+        settings Values for the fields of SpectrumSettings.
+    Returns:
+        A dict mapping each audio file to the first image of its sequence.
+    """
+    files = sorted(os.path.join(in_dir, f) for f in os.listdir(in_dir)
+                   if os.path.splitext(f)[1].lower() in AUDIO_EXTENSIONS)
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        results = executor.map(_export_file, [(f, out_dir, settings) for f in files])
+        return dict(zip(files, results))
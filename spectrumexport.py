@@ -3,11 +3,115 @@ This module contains the operator for the audio spectrum export.
 """
 import bpy
 import os
-import numpy as np
 
-from aud import Sound
+import numpy as np
 
-from . audio_helpers import collect_samples_safe, blackman_harris_window
+from . spectrumcache import SpectrumCache
+from . spectrumcore import PRESET_FIELDS, SCHEDULE_MODES, ExportJob, ExportStats, FrameScheduler, \
+    SpectrumSettings, SpectrumWorkers, create_cache, open_source, stats_path, write_frames
+from . spectrumfeatures import compute_features
+
+# Value of the LINEAR item of the keyframe interpolation enum
+LINEAR_INTERPOLATION = 1
+
+
+def output_name(props):
+    """
+    Returns the sanitized name of the export output, which is also the name
+    of the image in blender.
+    """
+    if not props.autoGenerateName:
+        return bpy.path.clean_name(props.image_name)
+    return bpy.path.clean_name(bpy.path.basename(props.input_sound_name)) + "_fft"
+
+
+def active_output_name(props):
+    """
+    Returns the output name of the active preset of the job, the output
+    name of the export if the job has no presets.
+    """
+    name = output_name(props)
+    if not 0 <= props.active_preset < len(props.presets):
+        return name
+    return f"{name}_{bpy.path.clean_name(props.presets[props.active_preset].name)}"
+
+
+def job_presets(props):
+    """
+    Returns the output names and settings of the export, one per preset of
+    the job or only the export properties if the job has no presets.
+    """
+    name = output_name(props)
+    if not len(props.presets):
+        return [(name, SpectrumSettings.from_props(props))]
+    return [(f"{name}_{bpy.path.clean_name(preset.name)}", SpectrumSettings.from_props(props, preset))
+            for preset in props.presets]
+
+
+def load_output(name: str, settings: SpectrumSettings, width: int, writer):
+    """
+    Points the image of the same name to a finished output, the image is
+    created if it does not exist. Arrays can't be loaded as image.
+    """
+    if settings.output_mode == "NPY":
+        return None
+    image = bpy.data.images.get(name)
+    if image is None:
+        image = bpy.data.images.new(name, width, settings.hist+1)
+
+    # Point to the first Element
+    image.filepath = writer.first_path()
+    image.colorspace_settings.name = "Non-Color"
+    if settings.stereo_mode == "LEFT_RIGHT":
+        # Alpha holds data, it must not be premultiplied
+        image.alpha_mode = "CHANNEL_PACKED"
+    image.reload()
+    # Set to image sequence or single atlas image
+    image.source = "SEQUENCE" if settings.output_mode == "SEQUENCE" else "FILE"
+    if settings.output_mode == "ATLAS":
+        # The layout of the tiles for build_atlas_nodes
+        image["atlas_columns"] = writer.columns
+        image["atlas_frames"] = writer.n_frames
+    return image
+
+
+def write_keyframes(id_data, prop_name: str, frames, values):
+    """
+    Replaces the animation of a custom property with one linear keyframe
+    per value. The keyframes are added in bulk instead of one by one.
+
+    Args:
+        id_data (bpy.types.ID) The owner of the property, e.g. an object.
+        prop_name (str) The name of the custom property.
+        frames (np.ndarray) The frame of each keyframe.
+        values (np.ndarray) The value of each keyframe.
+    Returns:
+        The F-curve of the property.
+    """
+    id_data[prop_name] = float(values[0])
+    data_path = f'["{prop_name}"]'
+
+    if id_data.animation_data is None:
+        id_data.animation_data_create()
+    if id_data.animation_data.action is None:
+        id_data.animation_data.action = bpy.data.actions.new(f"{id_data.name}Action")
+    action = id_data.animation_data.action
+
+    fcurve = action.fcurves.find(data_path)
+    if fcurve is None:
+        fcurve = action.fcurves.new(data_path)
+    else:
+        fcurve.keyframe_points.clear()
+
+    points = fcurve.keyframe_points
+    points.add(len(values))
+    co = np.empty(2*len(values), dtype=np.float32)
+    co[0::2] = frames
+    co[1::2] = values
+    points.foreach_set("co", co)
+    points.foreach_set("interpolation", np.full(len(values), LINEAR_INTERPOLATION, dtype=np.int32))
+    fcurve.update()
+    return fcurve
 
 
 class SpectrumExport(bpy.types.Operator):
@@ -18,23 +122,15 @@ class SpectrumExport(bpy.types.Operator):
     bl_label = "Export Audio Spectrum"
 
     _timer: None
-    data: None
-    time_elapsed: 0.0
-    sound_length: 0.0
-    samplerate: 0
-    n_frames_total: 0
-    min_gain: 0.0
-    inc: 0.0
-    n_digits: 0
-    fft_offset: 0
-    fft_out_width: 0
-    name_temp: ''
     fname: ''
-    number_format: ''
-    full_path: ''
-    final_out: None
-    img_mat: None
-    filetype: ''
+    job: None
+    n_done: 0
+    n_workers: 0
+    budget: 0
+    block: False
+    workers: None
+    scheduler: None
+    stats: None
 
     def modal(self, context, event):
         scene = context.scene
@@ -46,144 +142,40 @@ class SpectrumExport(bpy.types.Operator):
                 return {'CANCELLED'}
 
             if event.type == 'TIMER':
-                id_start = self.id
-                # Do 30 Frames per chunk
-                while(self.time_elapsed <= self.sound_length and self.id < id_start + 30):
-                    output = bpy.data.images.new(self.name_temp,
-                                                 self.final_res,
-                                                 props.hist+1
-                                                 )
-                    # Do processing
-                    # Move old entries back in history
-                    if props.hist:
-                        # We keep historic entries
-                        self.img_mat[1:, :, :] = self.img_mat[0:-1, :, :]
-
-                    # Calculate new center
-                    center_idx = int(self.time_elapsed * self.samplerate)
-
-                    # Get the to be processed samples
-                    to_process = collect_samples_safe(self.data,
-                                                      center_idx,
-                                                      props.window_size,
-                                                      dtype=np.float32)
-                    # Apply window
-                    blackman_harris_window(to_process)
-
-                    # Calculate the spectrum
-                    spectrum = np.fft.rfft(to_process,
-                                           props.window_size + props.zero_extension
-                                           )
-                    spectrum /= props.window_size
-
-                    freqs = np.abs(spectrum)
-                    phases = np.angle(spectrum)/(2*np.pi)
-
-                    nyquist = self.samplerate//2
-                    if np.abs(props.boostPerOctave) > 1e-2:
-                        # Apply boost
-                        # b = db/octave
-                        # a = gain = 10^(b/20)
-                        # f = a^(log2(x)); x = frequency
-                        freqs *= self.gain_per_octave**np.log2(np.linspace(0, nyquist, num=len(freqs))+1)
-
-                    if props.use_db:
-                        # Convert Data to db
-                        freqs_idx = freqs > self.min_gain
-                        freqs[freqs_idx] = 20*np.log10(freqs[freqs_idx])
-                        freqs[~freqs_idx] = props.minimum_db
-
-                        # Rescale from min_db-0 to 0-1
-                        freqs -= props.minimum_db
-
-                        freqs /= -props.minimum_db
-
-                    if props.logscale:
-                        # Frequencies in logspace
-                        min_v = np.log(props.min_freq)/np.log(props.logbase)
-                        max_v = np.log(props.max_freq)/np.log(props.logbase)
-                        # Calculate evaluating positions
-                        x = np.logspace(min_v,
-                                        max_v,
-                                        num=self.final_res,
-                                        base=props.logbase
-                                        )
-
-                        # Create Array of original sample positions
-                        xp = np.linspace(0, nyquist, num=len(freqs))
-
-                        # Interpoliate data
-                        res_f = np.interp(x, xp, freqs, left=0, right=0)
-                        freqs = res_f
-
-                        res_p =  np.interp(x, xp, phases, left=0, right=0)
-                        phases = res_p
-
-                    if props.bassRollOff:
-                        # Apply rolloff
-                        rolloffLen = int(self.final_res*.08)
-                        if rolloffLen > 0:
-                            # Rolloff is an upside down parabola -(x-1)^2+1
-                            # Quadratic looks better than linear
-                            freqs[0:rolloffLen] *= 1 - (np.linspace(-1, 0, num=rolloffLen)**2)
-
-                    if props.time_smoothing:
-                        # Apply time smoothing
-                        # Average phases and frequencies
-                        temp = freqs.copy()
-                        freqs[self.fft_offset:] *= .5
-                        freqs[self.fft_offset:] += .5 * self.pingpong[:, 0]
-                        self.pingpong[:, 0] = temp[self.fft_offset:]
-                        temp = phases.copy()
-                        phases[self.fft_offset:] *= .5
-                        phases[self.fft_offset:] += .5 * self.pingpong[:, 1]
-                        self.pingpong[:, 1] = temp[self.fft_offset:]
-
-                    # Save spectrum data in red
-                    self.img_mat[0, :, 0] = freqs[self.fft_offset:]
-
-                    # Save phase data in green
-                    self.img_mat[0, :, 1] = phases[self.fft_offset:]
-
-                    # Write pixel data
-                    output.pixels.foreach_set(self.img_mat.ravel())
-                    output.update()
-
-                    # Save data to filepath
-
-                    path = f"{self.full_path}{self.number_format.format(self.id)}.{self.filetype}"
-                    # Remove old file if it exists
-                    try:
-                        os.remove(path)
-                    except FileNotFoundError:
-                        pass
-
-                    output.filepath_raw = path
-
-                    output.file_format = "PNG"
-                    output.save()
-                    bpy.data.images.remove(output)
-
-                    # Advance time
-                    self.time_elapsed += self.inc
-                    self.id += 1
-
-                # Update Progress bar
-                props.progress = int((self.id-1)/self.n_frames_total*100)
-                context.area.tag_redraw()
-                context.area.tag_redraw()
-
-                if self.time_elapsed > self.sound_length:
+                # Results have to be consumed in order because of the
+                # history and the time smoothing. Encoding and saving
+                # happens on the writers process pool.
+                last_frame = write_frames(self.scheduler.take(), self.job, self.job, self.stats)
+                if last_frame is None and not self.scheduler.finished():
+                    # Next chunk is still being computed
+                    return {'PASS_THROUGH'}
+
+                if last_frame is not None:
+                    # Update Progress bar
+                    props.progress = int((self.n_done + last_frame + 1)/self.job.n_frames_total*100)
+                    if self.stats is not None:
+                        props.stats_summary = "\n".join(self.stats.summary())
+                    context.area.tag_redraw()
+
+                if self.scheduler.finished():
+                    # The presets of the group are finished
+                    self.workers.shutdown()
+                    group = self.job.finish_group()
+                    self.n_done += group.analysis.n_frames_total
+                    for name, settings, assembler, writer in zip(group.names, group.settings,
+                                                                 group.assemblers, group.writers):
+                        load_output(name, settings, assembler.width, writer)
+                    if self.job.group is not None:
+                        self.start_group()
+                        return {'PASS_THROUGH'}
+
                     # We are finished
-                    # Remove temp file
-
-                    # Point to the first Element
-                    self.final_out.filepath = f"{self.full_path}{self.number_format.format(1)}.{self.filetype}"
-                    self.final_out.colorspace_settings.name = "Non-Color"
-                    self.final_out.reload()
-                    # Set to image sequence
-                    self.final_out.source = "SEQUENCE"
+                    if self.stats is not None:
+                        self.stats.bytes_written = self.job.bytes_written
+                        props.stats_summary = "\n".join(self.stats.summary())
+                        self.stats.save(stats_path(props.write_path, self.fname))
                     props.isRunning = False
+                    self.cancel(context)
                     return {'FINISHED'}
 
             return {'PASS_THROUGH'}
@@ -194,100 +186,143 @@ class SpectrumExport(bpy.types.Operator):
             props.isRunning = False
             raise
 
+    def start_group(self):
+        """
+        Starts computing the spectra of the next group of presets in the background.
+        """
+        self.workers = SpectrumWorkers(self.job.group.analysis, self.n_workers)
+        self.scheduler = FrameScheduler(self.workers, self.budget, self.block)
+
     def execute(self, context):
         scene = context.scene
         props = scene.spectrum_export_props
-        # Retrieve input.
+        # Plain copies of the settings that are safe to read from the workers
+        presets = job_presets(props)
+        names = [name for name, _ in presets]
+        if len(set(names)) < len(names):
+            self.report({'ERROR'}, "The presets need different names")
+            return {'CANCELLED'}
+
+        self.fname = output_name(props)
+        self.stats = ExportStats(0) if props.collect_stats else None
+        props.stats_summary = ""
+
+        # Retrieve input, the raw spectra may come from the cache
         audiopath = bpy.path.abspath(props.input_sound_name)
-        sound = Sound(audiopath)
-        self.samplerate, channels = sound.specs
+        self.job = ExportJob(audiopath, presets, props.write_path, stats=self.stats)
+        self.n_done = 0
+        if self.stats is not None:
+            self.stats.n_frames = self.job.n_frames_total
 
-        # Calculate audio time in seconds
-        self.sound_length = sound.length/self.samplerate
+        interval, self.budget, self.block, free_cores = SCHEDULE_MODES[props.schedule_mode]
+        self.n_workers = max((os.cpu_count() or 1) - free_cores, 1)
+        self.start_group()
 
-        # Read the samples
-        self.data = sound.data()
+        props.isRunning = True
+        props.progress = 0
 
-        # Sum data to mono
-        self.data = np.mean(self.data, axis=1)
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(interval, window=context.window)
+        wm.modal_handler_add(self)
 
-        if props.normalize:
-            # Normalize Data
-            smax = np.max(np.abs(self.data))
-            if smax > 1e-9:
-                self.data /= smax
+        return {'RUNNING_MODAL'}
 
-        self.data *= 10**(props.gain/20)
+    def cancel(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        self.workers.shutdown()
+        self.job.cancel()
 
-        self.min_gain = 10**(props.minimum_db/20)
 
-        # Calculate time increment per second
-        self.inc = 1/props.fps
+class SpectrumPresetAdd(bpy.types.Operator):
+    """Add an output preset with the current settings to the export job"""
 
-        # Calculate total amount of required frames
-        self.n_frames_total = int(self.sound_length/self.inc) + 1
+    bl_category = "Audio Tools"
+    bl_idname = "scene.spectrum_preset_add"
+    bl_label = "Add Spectrum Preset"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        # Calculate amount of digits needed to represent all framenumbers
-        self.n_digits = int(np.floor(np.log10(self.n_frames_total))) + 1
+    def execute(self, context):
+        props = context.scene.spectrum_export_props
+        preset = props.presets.add()
+        preset.name = f"preset{len(props.presets)}"
+        for name in PRESET_FIELDS:
+            setattr(preset, name, getattr(props, name))
+        props.active_preset = len(props.presets) - 1
+        return {'FINISHED'}
 
-        self.fft_offset = 0 if props.keep_dc_offset or props.logscale else 1
-        self.fft_out_width = (props.window_size + props.zero_extension)//2 + (1-self.fft_offset)
-        self.final_res = self.fft_out_width if not props.logscale else props.n_output
 
-        filename_sanitized = bpy.path.clean_name(
-                                bpy.path.basename(props.input_sound_name)
-                                ) + "_fft"
+class SpectrumPresetRemove(bpy.types.Operator):
+    """Remove the active output preset from the export job"""
 
-        if not props.autoGenerateName:
-            filename_sanitized = bpy.path.clean_name(props.image_name)
+    bl_category = "Audio Tools"
+    bl_idname = "scene.spectrum_preset_remove"
+    bl_label = "Remove Spectrum Preset"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        buffer_name = f"{filename_sanitized}"
-        self.full_path = f"{props.write_path}/{buffer_name}_"
-        self.number_format = "{0:0"+str(self.n_digits)+"d}"
-        self.filetype = "png"
+    @classmethod
+    def poll(cls, context):
+        props = context.scene.spectrum_export_props
+        return 0 <= props.active_preset < len(props.presets)
+
+    def execute(self, context):
+        props = context.scene.spectrum_export_props
+        props.presets.remove(props.active_preset)
+        props.active_preset = min(props.active_preset, len(props.presets) - 1)
+        return {'FINISHED'}
 
-        os.makedirs(props.write_path, exist_ok=True)
 
-        # Create output image buffer, also used for creating the files
-        self.name_temp = f"{filename_sanitized}_spectrum_temp"
-        self.fname = f"{filename_sanitized}"
-        self.gain_per_octave = 10**(props.boostPerOctave/20)
+class SpectrumFeatureExport(bpy.types.Operator):
+    """Export band energies, flux and onsets of the audio as keyframes on custom properties"""
 
-        if self.name_temp in bpy.data.images.keys():
-            # Remove image to make sure we are using the right dimensions
-            bpy.data.images.remove(bpy.data.images[self.name_temp])
+    bl_category = "Audio Tools"
+    bl_idname = "anim.export_spectrum_features"
+    bl_label = "Export Audio Features"
+    bl_options = {'REGISTER', 'UNDO'}
 
-        # Create final output image if not exists
-        if self.fname not in bpy.data.images.keys():
-            self.final_out = bpy.data.images.new(self.fname,
-                                                 self.final_res,
-                                                 props.hist+1
-                                                 )
+    def execute(self, context):
+        scene = context.scene
+        props = scene.spectrum_export_props
+        settings = SpectrumSettings.from_props(props)
+        # The treble band reaches above the highest frequency of the spectrum
+        settings.decimate = False
+
+        if props.feature_target == "OBJECT":
+            if context.object is None:
+                self.report({'ERROR'}, "No active object to animate")
+                return {'CANCELLED'}
+            target = context.object
         else:
-            self.final_out = bpy.data.images[self.fname]
+            target = scene
 
-        self.id = 1
+        audiopath = bpy.path.abspath(props.input_sound_name)
+        source = open_source(audiopath, settings, create_cache(settings))
+        try:
+            features = compute_features(source, settings)
+        except BaseException:
+            source.discard()
+            raise
 
-        # Allocate pixel matrix
-        self.img_mat = np.zeros((props.hist+1, self.final_res, 4),
-                                dtype=np.float32
-                                )
-        self.time_elapsed = 0
+        # Output frame N lies on scene frame N + 1 like the image sequence
+        scene_fps = scene.render.fps/scene.render.fps_base
+        n_frames = source.n_frames_total
+        frames = 1 + np.arange(n_frames)*scene_fps/settings.fps
 
-        if props.time_smoothing:
-            self.pingpong = np.zeros((self.final_res, 4),
-                                     dtype=np.float32
-                                     )
+        name = output_name(props)
+        for feature, values in features.items():
+            write_keyframes(target, f"{name}_{feature}", frames, values)
 
-        props.isRunning = True
-        props.progress = 0
+        self.report({'INFO'}, f"Wrote {len(features)} features with {n_frames} keyframes each")
+        return {'FINISHED'}
 
-        wm = context.window_manager
-        self._timer = wm.event_timer_add(0.1, window=context.window)
-        wm.modal_handler_add(self)
 
-        return {'RUNNING_MODAL'}
+class SpectrumClearCache(bpy.types.Operator):
+    """Remove all cached spectra"""
 
-    def cancel(self, context):
-        wm = context.window_manager
-        wm.event_timer_remove(self._timer)
+    bl_category = "Audio Tools"
+    bl_idname = "file.clear_spectrum_cache"
+    bl_label = "Clear Spectrum Cache"
+
+    def execute(self, context):
+        SpectrumCache().clear()
+        return {'FINISHED'}
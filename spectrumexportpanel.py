@@ -5,6 +5,10 @@ import bpy
 import aud
 import numpy as np
 
+from . audio_helpers import decimation_factor
+from . spectrumexport import active_output_name
+from . spectrumpreview import preview_running
+
 
 class SpectrumExportPanel(bpy.types.Panel):
     """
@@ -58,6 +62,12 @@ class SpectrumExportPanel(bpy.types.Panel):
         row = box.row()
         row.prop(props, "zero_extension", text="Zero Extension")
         row = box.row()
+        row.prop(props, "window_type", text="Window")
+        row = box.row()
+        row.prop(props, "stereo_mode", text="Stereo")
+        row = box.row()
+        row.prop(props, "output_channels", text="Channels")
+        row = box.row()
         # Calculate total window size
         total = props.window_size + props.zero_extension
         row.label(text=f"Total: {total}")
@@ -105,6 +115,13 @@ class SpectrumExportPanel(bpy.types.Panel):
         row.prop(props, "max_freq", text="Max. Frequency")
         row = box2.row()
         row.prop(props, "n_output", text="Resolution")
+        row.prop(props, "band_mode", text="Bands")
+        row = box2.row()
+        row.prop(props, "filterbank", text="Filterbank")
+        row = box2.row()
+        row.prop(props, "decimate", text="Decimate")
+        if props.decimate and isReadable:
+            row.label(text=f"Samplerate / {decimation_factor(samplerate, props.max_freq)}")
         if isReadable and samplerate//2 < props.max_freq:
             row = box2.row()
             row.label(text=f"Warning, any frequency above {samplerate//2} will be zero.",
@@ -118,6 +135,15 @@ class SpectrumExportPanel(bpy.types.Panel):
         row.prop(props, "normalize", text="Normalize")
         row.prop(props, "bassRollOff", text="Bass Rolloff")
         row.prop(props, "time_smoothing", text="Time Smoothing")
+        if props.time_smoothing:
+            row = box2.row()
+            row.prop(props, "smoothing_mode", text="Smoothing")
+            row.prop(props, "zero_phase", text="Zero Phase")
+            if props.smoothing_mode != "AVERAGE":
+                row = box2.row()
+                if props.smoothing_mode == "ENVELOPE":
+                    row.prop(props, "attack_time", text="Attack")
+                row.prop(props, "release_time", text="Release" if props.smoothing_mode == "ENVELOPE" else "Decay")
         row = box2.row()
         row.prop(props, "gain", text="Volume Gain")
         row = box2.row()
@@ -140,6 +166,21 @@ class SpectrumExportPanel(bpy.types.Panel):
         row = box.row()
         row.prop(props, "write_path", text="Output dir")
         row = box.row()
+        row.prop(props, "use_cache", text="Cache Spectra")
+        row.prop(props, "cache_size", text="Cache Size (MB)")
+        row.operator("file.clear_spectrum_cache", text="Clear Cache")
+        row = box.row()
+        row.prop(props, "output_mode", text="Output")
+        if props.output_mode == "SEQUENCE":
+            row.prop(props, "resume", text="Skip Unchanged")
+        row = box.row()
+        row.prop(props, "mip_levels", text="Mip Levels")
+        if props.mip_levels:
+            row.prop(props, "mip_pooling", text="Pooling")
+        row = box.row()
+        row.prop(props, "color_depth", text="Color Depth")
+        row.prop(props, "compression", text="Compression")
+        row = box.row()
         col = row.column()
         col.prop(props, "autoGenerateName", text="Auto Generate Name")
         col = row.column()
@@ -147,13 +188,70 @@ class SpectrumExportPanel(bpy.types.Panel):
         col.enabled = not props.autoGenerateName
         valid_name = (props.image_name and not props.autoGenerateName) or props.autoGenerateName
 
+        # Presets exported together, they share the analysis of the audio
+        box2 = box.box()
+        box2.label(text="Job Presets")
+        row = box2.row()
+        row.template_list("UI_UL_list", "spectrum_presets", props, "presets", props, "active_preset", rows=2)
+        col = row.column(align=True)
+        col.operator("scene.spectrum_preset_add", icon="ADD", text="")
+        col.operator("scene.spectrum_preset_remove", icon="REMOVE", text="")
+        if 0 <= props.active_preset < len(props.presets):
+            preset = props.presets[props.active_preset]
+            row = box2.row()
+            row.prop(preset, "logscale", text="Log Scale")
+            row.prop(preset, "n_output", text="Resolution")
+            row.prop(preset, "hist", text="Keep Previous")
+            row = box2.row()
+            row.enabled = preset.logscale
+            row.prop(preset, "min_freq", text="Min. Frequency")
+            row.prop(preset, "max_freq", text="Max. Frequency")
+            row = box2.row()
+            row.prop(preset, "use_db", text="Use dbFS scaling")
+            if preset.use_db:
+                row.prop(preset, "minimum_db", text="Min. dB")
+            row = box2.row()
+            row.prop(preset, "time_smoothing", text="Time Smoothing")
+            if preset.time_smoothing:
+                row.prop(preset, "smoothing_mode", text="Smoothing")
+
         # Finally ad operator
         row = box.row()
-        row.operator("file.export_spectrum", text="Generate")
+        row.operator("file.export_spectrum",
+                     text=f"Generate {len(props.presets)} Presets" if len(props.presets) else "Generate")
         row.enabled = is_power_of_two and isReadable and valid_name
         row = box.row()
+        running = preview_running()
+        row.operator("image.toggle_spectrum_preview", text="Stop Preview" if running else "Preview",
+                     depress=running)
+        row.enabled = running or (is_power_of_two and isReadable)
+        row = box.row()
         row.prop(props, "progress", text="Progress")
         row.enabled = False
+        row = box.row()
+        row.prop(props, "schedule_mode", text="Scheduling")
+        row.prop(props, "collect_stats", text="Show Timings")
+
+        if props.output_mode == "ATLAS":
+            row = box.row()
+            op = row.operator("material.add_spectrum_atlas_nodes", text="Add Atlas Nodes to Material")
+            op.image_name = active_output_name(props)
+            row.enabled = op.image_name in bpy.data.images
+
+        # Scalar features as keyframes instead of images
+        box2 = box.box()
+        box2.label(text="Features")
+        row = box2.row()
+        row.prop(props, "feature_target", text="Target")
+        row.operator("anim.export_spectrum_features", text="Export Features")
+        row.enabled = is_power_of_two and isReadable and valid_name
 
         # Gray out if running
         box.enabled = not props.isRunning
+
+        # Outside of the box, so the timings stay readable while running
+        if props.collect_stats and props.stats_summary:
+            stats_box = layout.box()
+            stats_box.label(text="Timings")
+            for line in props.stats_summary.split("\n"):
+                stats_box.label(text=line)
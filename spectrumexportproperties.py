@@ -2,7 +2,57 @@
 This module contains the necessary properties for the audio export
 """
 import bpy
-from bpy.props import BoolProperty, FloatProperty, IntProperty, StringProperty
+from bpy.props import BoolProperty, CollectionProperty, EnumProperty, FloatProperty, IntProperty, StringProperty
+
+class SpectrumExportPreset(bpy.types.PropertyGroup):
+    """
+    An output of an export job. The settings replace the export properties
+    of the same name, all presets share the other properties.
+    """
+
+    logscale: BoolProperty(name="Logarithmic Frequency Scaling",
+                           description="If true the frequencies displayed in a logplot fashion.",
+                           default=True)
+
+    min_freq: FloatProperty(name="Mininmal Frequecy",
+                            description="Sets the smallest frequency to be displayed. Only works if Logarithmic Scale is on.",
+                            default=20,
+                            min=1)
+
+    max_freq: FloatProperty(name="Maximal Frequecy",
+                            description="Sets the highest frequency to be displayed. Only works if Logarithmic Scale is on.",
+                            default=21050,
+                            min=1,
+                            max=100000)
+
+    n_output: IntProperty(name="Output Resolution", description="Number of Pixels, only has an effect in logscale", default=2048)
+
+    use_db: BoolProperty(name="Use dB instead of Gain",
+                         description="Values will be in dbFS scaling instead of linear one.",
+                         default=True)
+
+    minimum_db: FloatProperty(name="Minimum dB",
+                              description="This value will be intensitiy 0 in the image.",
+                              default=-18,
+                              max=-3)
+
+    hist: IntProperty(name="Keep Previous",
+                      description="How many previous spectra should be saved.",
+                      default=0,
+                      min=0)
+
+    time_smoothing: BoolProperty(name="Time Smoothing",
+                                 description="If true the spectra are smoothed over time.",
+                                 default=False)
+
+    smoothing_mode: EnumProperty(name="Smoothing",
+                                 description="How the spectra are smoothed over time, attack and release come from the export.",
+                                 items=[("AVERAGE", "Average", "The mean of the spectrum and the previous spectrum"),
+                                        ("ENVELOPE", "Envelope", "Follows rising values with the attack and falling values with the release time"),
+                                        ("PEAK_HOLD", "Peak Hold", "Holds the peaks, which fall with the decay time"),
+                                        ],
+                                 default="AVERAGE")
+
 
 class SpectrumExportProperties(bpy.types.PropertyGroup):
     """
@@ -23,6 +73,32 @@ class SpectrumExportProperties(bpy.types.PropertyGroup):
                                 default=1024,
                                 min=0)
 
+    window_type: EnumProperty(name="Window Function",
+                              description="The window function applied to the samples before the Fourier transform.",
+                              items=[("BLACKMAN_HARRIS", "Blackman-Harris", "Low leakage, good default for visualizations"),
+                                     ("HANN", "Hann", "Narrow peaks with moderate leakage"),
+                                     ("HAMMING", "Hamming", "Narrow peaks, higher far leakage than Hann"),
+                                     ("FLAT_TOP", "Flat Top", "Accurate peak amplitudes but wide peaks"),
+                                     ("KAISER", "Kaiser", "Kaiser window with beta 8.6"),
+                                     ],
+                              default="BLACKMAN_HARRIS")
+
+    stereo_mode: EnumProperty(name="Stereo",
+                              description="Additional spectra of the stereo channels. Red and green always hold the mono spectrum.",
+                              items=[("NONE", "None", "Only the mono spectrum"),
+                                     ("SIDE", "Side", "Magnitudes of the side (left minus right) spectrum in blue"),
+                                     ("LEFT_RIGHT", "Left/Right", "Magnitudes of the left spectrum in blue and of the right spectrum in alpha"),
+                                     ],
+                              default="NONE")
+
+    output_channels: EnumProperty(name="Channels",
+                                  description="Which values of the mono spectrum are calculated and written. Left out values are skipped entirely.",
+                                  items=[("MAGNITUDE_PHASE", "Magnitude and Phase", "Magnitudes in red and phases in green"),
+                                         ("MAGNITUDE", "Magnitude", "Only the magnitudes, written as grayscale without stereo"),
+                                         ("PHASE", "Phase", "Only the phases, written as grayscale without stereo"),
+                                         ],
+                                  default="MAGNITUDE_PHASE")
+
     fps: FloatProperty(name="FPS",
                        description="How many FPS the generated sequence will have.",
                        default=30,
@@ -70,6 +146,27 @@ class SpectrumExportProperties(bpy.types.PropertyGroup):
                             min=1,
                             max=100000)
 
+    decimate: BoolProperty(name="Decimate",
+                           description="Lower the samplerate before the Fourier transform as far as Max. Frequency allows. Much faster for low Max. Frequencies, the resolution stays the same.",
+                           default=False)
+
+    band_mode: EnumProperty(name="Band Mode",
+                            description="How the frequency bins are mapped onto the pixels of the logarithmic scale.",
+                            items=[("INTERPOLATE", "Interpolate", "Linearly interpolate between the nearest bins"),
+                                   ("MEAN", "Mean", "Average all bins that fall into a pixel, prevents aliasing at high frequencies"),
+                                   ("MAX", "Max", "Take the loudest bin that falls into a pixel, prevents aliasing at high frequencies"),
+                                   ],
+                            default="INTERPOLATE")
+
+    filterbank: EnumProperty(name="Filterbank",
+                             description="Filters the spectrum with overlapping bands instead of mapping the bins onto a log scale. Only has an effect in logscale.",
+                             items=[("NONE", "None", "Map the bins onto the log scale with the band mode"),
+                                    ("CQT", "Constant-Q", "Log spaced bands whose width is proportional to their frequency"),
+                                    ("MEL", "Mel", "Bands equally spaced on the mel pitch scale"),
+                                    ("BARK", "Bark", "Bands equally spaced on the Bark critical band scale"),
+                                    ],
+                             default="NONE")
+
     normalize: BoolProperty(name="Normalize Audio",
                            description="If true the absolute of the highest sample in the audio will be 1. Everything will be scaled accordingly.",
                            default=True)
@@ -82,6 +179,60 @@ class SpectrumExportProperties(bpy.types.PropertyGroup):
                        min=-60,
                        max=100)
 
+    output_mode: EnumProperty(name="Output Mode",
+                              description="How the frames are written.",
+                              items=[("SEQUENCE", "Image Sequence", "One PNG per frame"),
+                                     ("ATLAS", "Atlas", "One PNG with a row per frame, the top row is the first frame. Long tracks are wrapped into columns. Keep Previous is ignored"),
+                                     ("NPY", "NumPy Array", "One float .npy file with a row per frame, for scripts. Keep Previous is ignored"),
+                                     ],
+                              default="SEQUENCE")
+
+    mip_levels: IntProperty(name="Mip Levels",
+                            description="Number of additional outputs, each a quarter of the width of the previous one. Every pixel combines the pixels of the full width it covers.",
+                            default=0,
+                            min=0,
+                            max=5)
+
+    mip_pooling: EnumProperty(name="Mip Pooling",
+                              description="How the pixels of the full width are combined into the pixels of the smaller levels.",
+                              items=[("MEAN", "Mean", "The average of the pixels"),
+                                     ("MAX", "Max", "The loudest of the pixels, keeps narrow peaks visible"),
+                                     ],
+                              default="MEAN")
+
+    resume: BoolProperty(name="Skip Unchanged Frames",
+                         description="Keeps a manifest of the written frames in the output directory. A rerun only writes the frames that changed or are missing, e.g. after a cancelled export.",
+                         default=True)
+
+    color_depth: EnumProperty(name="Color Depth",
+                              description="Bits per channel of the written images. 16 bit keeps fine gradients of the spectrum.",
+                              items=[("8", "8", "8 bit per channel"),
+                                     ("16", "16", "16 bit per channel"),
+                                     ],
+                              default="8")
+
+    compression: IntProperty(name="Compression",
+                             description="Compression level of the written images. Lower values are faster but create larger files.",
+                             default=6,
+                             min=0,
+                             max=9)
+
+    use_cache: BoolProperty(name="Cache Spectra",
+                            description="Keep the raw spectra on disk, so changing only visual settings skips decoding and the Fourier transform.",
+                            default=True)
+
+    cache_size: IntProperty(name="Cache Size",
+                            description="Maximum size of the spectrum cache in MB. The least recently used spectra are removed first.",
+                            default=2048,
+                            min=0)
+
+    feature_target: EnumProperty(name="Feature Target",
+                                 description="Where the keyframes of the audio features are written to.",
+                                 items=[("SCENE", "Scene", "Custom properties of the scene"),
+                                        ("OBJECT", "Active Object", "Custom properties of the active object"),
+                                        ],
+                                 default="SCENE")
+
     progress: FloatProperty(name="Progress",
                             subtype="PERCENTAGE",
                             soft_min=0,
@@ -90,6 +241,22 @@ class SpectrumExportProperties(bpy.types.PropertyGroup):
 
     isRunning: BoolProperty(name="Is Running", default=False)
 
+    schedule_mode: EnumProperty(name="Scheduling",
+                                description="How the export shares the time with the user interface.",
+                                items=[("BACKGROUND", "Background", "Keeps blender responsive and leaves a core free, the export takes longer"),
+                                       ("BALANCED", "Balanced", "Works about 50 ms between interface updates"),
+                                       ("THROUGHPUT", "Max Throughput", "Exports as fast as possible, the interface only updates twice a second"),
+                                       ],
+                                default="BALANCED")
+
+    collect_stats: BoolProperty(name="Show Timings",
+                                description="Measures the time of each stage of the export, shows it below the progress and writes it to a JSON file next to the output.",
+                                default=False)
+
+    stats_summary: StringProperty(name="Timings",
+                                  description="The measured timings of the current or last export, one line per entry.",
+                                  default="")
+
     autoGenerateName: BoolProperty(name="Autogenerate Name",
                                    description="If true the output name will be auto generated.",
                                    default=False)
@@ -106,6 +273,36 @@ class SpectrumExportProperties(bpy.types.PropertyGroup):
                                    description="If true the position will be averaged to make the motion smoother.",
                                    default=False)
 
+    smoothing_mode: EnumProperty(name="Smoothing",
+                                 description="How the spectra are smoothed over time.",
+                                 items=[("AVERAGE", "Average", "The mean of the spectrum and the previous spectrum"),
+                                        ("ENVELOPE", "Envelope", "Follows rising values with the attack and falling values with the release time"),
+                                        ("PEAK_HOLD", "Peak Hold", "Holds the peaks, which fall with the decay time"),
+                                        ],
+                                 default="AVERAGE")
+
+    attack_time: FloatProperty(name="Attack",
+                               description="Time in seconds the envelope needs to follow a rising value by 63%.",
+                               default=0.01,
+                               min=0,
+                               max=1)
+
+    release_time: FloatProperty(name="Release",
+                                description="Time in seconds the envelope needs to follow a falling value by 63%, or the held peaks to fall by 63%.",
+                                default=0.2,
+                                min=0,
+                                max=1)
+
+    zero_phase: BoolProperty(name="Zero Phase",
+                             description="Smooth forward and backward in time, so the smoothing does not lag behind the audio.",
+                             default=False)
+
+    presets: CollectionProperty(type=SpectrumExportPreset,
+                                name="Presets",
+                                description="Outputs exported together from one analysis of the audio. If empty the settings above are exported.")
+
+    active_preset: IntProperty(name="Active Preset", default=0)
+
     boostPerOctave: FloatProperty(name="High Frequency Boost",
                                   description="Sets how much dB per octave should be added. This can be used to make higer frequencies stronger if they are too weak",
                                   default=0)
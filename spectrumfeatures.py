@@ -0,0 +1,131 @@
+"""
+This module contains the per frame audio features, like the energy of
+frequency bands and the onset strength. It does not depend on blender.
+"""
+import numpy as np
+
+from . audio_helpers import get_window
+from . spectrumcore import SpectrumSettings, sample_scale
+
+# Frequency ranges of the band energies in Hz
+BANDS = {"bass": (20, 250), "mid": (250, 4000), "treble": (4000, 20000)}
+
+FEATURES = ("rms", *BANDS, "flux", "onset")
+
+# Frames per block, only the raw spectra of one block are in memory
+FEATURE_CHUNK_SIZE = 512
+
+# Compression of the magnitudes before the flux, log(1 + gamma*x)
+FLUX_GAMMA = 100
+
+# Half width of the moving average subtracted from the flux in seconds
+ONSET_CONTEXT = 0.1
+
+
+def energy_matrix(n_fft: int, window, samplerate: int, bands: dict = BANDS):
+    """
+    Returns the matrix mapping the power spectrum of a frame to the window
+    compensated mean square sum(x_w**2)/sum(w**2) of the windowed samples
+    x_w in total and within each band. By Parseval the energy of the
+    windowed samples equals the energy of the spectrum, the bins between
+    DC and Nyquist count twice in the one sided spectrum.
+
+    Args:
+        n_fft (int) The FFT size.
+        window (np.ndarray) The window the spectra were calculated with.
+        samplerate (int) The samplerate of the audio.
+        bands (dict, optional) Maps the band names to (low, high) in Hz.
+    Returns:
+        An array of shape (n_fft//2 + 1, 1 + len(bands)).
+    """
+    n_bins = n_fft//2 + 1
+    weights = np.full(n_bins, 2.0)
+    weights[0] = 1
+    if n_fft % 2 == 0:
+        weights[-1] = 1
+    # The spectra are normalized by the window size
+    weights *= len(window)**2/(n_fft*np.sum(window**2))
+
+    freqs = np.arange(n_bins)*samplerate/n_fft
+    matrix = np.zeros((n_bins, 1 + len(bands)))
+    matrix[:, 0] = weights
+    for i, (low, high) in enumerate(bands.values()):
+        in_band = (freqs >= low) & (freqs < high)
+        matrix[in_band, i + 1] = weights[in_band]
+    return matrix
+
+
+def level_to_unit(values, settings: SpectrumSettings):
+    """
+    Maps linear levels onto 0-1 with the dB settings of the spectrum.
+    """
+    if not settings.use_db:
+        return values
+    values = 20*np.log10(np.maximum(values, 10**(settings.minimum_db/20)))
+    return (values - settings.minimum_db)/-settings.minimum_db
+
+
+def compute_features(source, settings: SpectrumSettings, bands: dict = BANDS,
+                     chunk_size: int = FEATURE_CHUNK_SIZE):
+    """
+    Calculates the features of all frames of a source. The levels use the
+    normalization, gain and dB settings of the spectrum, flux and onset
+    are scaled so their highest value is 1.
+
+    rms: The window compensated root mean square of the samples,
+        sqrt(sum(x_w**2)/sum(w**2)) with the window w and the windowed
+        samples x_w. A constant signal keeps its RMS.
+    bass, mid, treble: The same within the bands.
+    flux: The summed increase of the log compressed magnitudes.
+    onset: The flux above its moving average.
+
+    Args:
+        source (FrameSource or CachedSource) The source of the raw spectra,
+            it is finished after the last frame.
+        settings (SpectrumSettings) The settings of the export.
+        bands (dict, optional) Maps the band names to (low, high) in Hz.
+        chunk_size (int, optional) Frames per block.
+    Returns:
+        A dict mapping the feature names to float32 arrays with one value
+        per frame.
+    """
+    n_frames = source.n_frames_total
+    n_fft = settings.window_size + settings.zero_extension
+    window = get_window(settings.window_type, settings.window_size, dtype=np.float64)
+    matrix = energy_matrix(n_fft, window, source.samplerate, bands)
+    scale = sample_scale(source.peak, settings)
+
+    levels = np.empty((n_frames, matrix.shape[1]))
+    flux = np.zeros(n_frames)
+    previous = None
+    for start in range(0, n_frames, chunk_size):
+        frame_ids = np.arange(start, min(start + chunk_size, n_frames))
+        spectra = source.spectra(frame_ids, source.read(frame_ids))
+        if spectra.ndim == 3:
+            # Mono mix of all channels, files with more than two bring their own
+            spectra = spectra[:, 2] if spectra.shape[1] > 2 else spectra.mean(axis=1)
+        mags = np.abs(spectra)*scale
+
+        levels[frame_ids] = np.sqrt(np.square(mags) @ matrix)
+
+        # Positive change to the previous frame, the first frame has none
+        compressed = np.log1p(FLUX_GAMMA*mags)
+        if previous is None:
+            previous = compressed[0]
+        diff = np.diff(compressed, axis=0, prepend=previous[None])
+        flux[frame_ids] = np.sum(np.maximum(diff, 0), axis=1)
+        previous = compressed[-1]
+    source.finish()
+
+    # Onsets stand out from the flux of the surrounding frames
+    half_width = max(int(round(ONSET_CONTEXT*settings.fps)), 1)
+    kernel = np.full(2*half_width + 1, 1/(2*half_width + 1))
+    onset = np.maximum(flux - np.convolve(flux, kernel, mode="same"), 0)
+
+    features = {"rms": level_to_unit(levels[:, 0], settings)}
+    for i, name in enumerate(bands):
+        features[name] = level_to_unit(levels[:, i + 1], settings)
+    for name, values in (("flux", flux), ("onset", onset)):
+        peak = values.max(initial=0)
+        features[name] = values/peak if peak > 0 else values
+    return {name: values.astype(np.float32) for name, values in features.items()}
@@ -0,0 +1,132 @@
+"""
+This module contains the helper for sampling a spectrum atlas in shaders.
+"""
+import bpy
+from bpy.props import StringProperty
+
+from . spectrumexport import active_output_name
+
+
+def build_atlas_nodes(node_tree, image):
+    """
+    Adds nodes to a shader node tree that sample the tile of the atlas
+    belonging to the current frame. The U coordinate of the UV map selects
+    the frequency. Frame 1 is the top left tile of the atlas, the frames
+    fill the rows left to right, see atlas_layout.
+
+    Args:
+        node_tree (bpy.types.NodeTree) The shader node tree.
+        image (bpy.types.Image) The atlas image.
+    Returns:
+        The image texture node, its color output holds the spectrum.
+    """
+    nodes = node_tree.nodes
+    links = node_tree.links
+    # Atlases of older exports have a single column
+    columns = image.get("atlas_columns", 1)
+    n_frames = image.get("atlas_frames", image.size[1])
+    rows = -(-n_frames//columns)
+    tile_width = image.size[0]//columns
+
+    tex_coord = nodes.new("ShaderNodeTexCoord")
+    tex_coord.location = (-1000, 200)
+    separate = nodes.new("ShaderNodeSeparateXYZ")
+    separate.location = (-800, 200)
+    links.new(tex_coord.outputs["UV"], separate.inputs[0])
+
+    # Row and column of the current frame through drivers
+    index = f"max(min(floor(frame) - 1, {n_frames - 1}), 0)"
+    row = nodes.new("ShaderNodeValue")
+    row.label = "Row"
+    row.location = (-1000, -50)
+    row.outputs[0].driver_add("default_value").driver.expression = f"floor({index}/{columns})"
+    column = nodes.new("ShaderNodeValue")
+    column.label = "Column"
+    column.location = (-1000, -250)
+    column.outputs[0].driver_add("default_value").driver.expression = f"fmod({index}, {columns})"
+
+    # Keep the outer pixels of the tile, the neighbouring tiles must not
+    # bleed in: u = (column + clamp(x))/columns
+    clamp = nodes.new("ShaderNodeClamp")
+    clamp.inputs["Min"].default_value = .5/tile_width
+    clamp.inputs["Max"].default_value = 1 - .5/tile_width
+    clamp.location = (-600, 200)
+    links.new(separate.outputs["X"], clamp.inputs["Value"])
+
+    offset_u = nodes.new("ShaderNodeMath")
+    offset_u.operation = "ADD"
+    offset_u.location = (-600, -250)
+    links.new(column.outputs[0], offset_u.inputs[0])
+    links.new(clamp.outputs[0], offset_u.inputs[1])
+
+    scale_u = nodes.new("ShaderNodeMath")
+    scale_u.operation = "DIVIDE"
+    scale_u.inputs[1].default_value = columns
+    scale_u.location = (-400, -250)
+    links.new(offset_u.outputs[0], scale_u.inputs[0])
+
+    # Row center of the frame: v = 1 - (row + 0.5)/rows
+    offset_v = nodes.new("ShaderNodeMath")
+    offset_v.operation = "ADD"
+    offset_v.inputs[1].default_value = 0.5
+    offset_v.location = (-800, -50)
+    links.new(row.outputs[0], offset_v.inputs[0])
+
+    scale_v = nodes.new("ShaderNodeMath")
+    scale_v.operation = "DIVIDE"
+    scale_v.inputs[1].default_value = rows
+    scale_v.location = (-600, -50)
+    links.new(offset_v.outputs[0], scale_v.inputs[0])
+
+    flip = nodes.new("ShaderNodeMath")
+    flip.operation = "SUBTRACT"
+    flip.inputs[0].default_value = 1
+    flip.location = (-400, -50)
+    links.new(scale_v.outputs[0], flip.inputs[1])
+
+    combine = nodes.new("ShaderNodeCombineXYZ")
+    combine.location = (-200, 0)
+    links.new(scale_u.outputs[0], combine.inputs["X"])
+    links.new(flip.outputs[0], combine.inputs["Y"])
+
+    texture = nodes.new("ShaderNodeTexImage")
+    texture.image = image
+    texture.extension = "EXTEND"
+    texture.location = (0, 200)
+    links.new(combine.outputs[0], texture.inputs["Vector"])
+    return texture
+
+
+class SpectrumAtlasNodes(bpy.types.Operator):
+    """Add nodes sampling the exported spectrum atlas at the current frame to the active material"""
+
+    bl_category = "Audio Tools"
+    bl_idname = "material.add_spectrum_atlas_nodes"
+    bl_label = "Add Spectrum Atlas Nodes"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    image_name: StringProperty(name="Image",
+                               description="The atlas image, defaults to the output of the active preset",
+                               default="")
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None
+
+    def execute(self, context):
+        props = context.scene.spectrum_export_props
+        name = self.image_name or active_output_name(props)
+        image = bpy.data.images.get(name)
+        if image is None:
+            self.report({'ERROR'}, f"No atlas image {name}, export the atlas first")
+            return {'CANCELLED'}
+
+        obj = context.object
+        material = obj.active_material
+        if material is None:
+            material = bpy.data.materials.new(f"{image.name}_material")
+            obj.active_material = material
+        material.use_nodes = True
+
+        build_atlas_nodes(material.node_tree, image)
+        return {'FINISHED'}
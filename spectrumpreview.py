@@ -0,0 +1,153 @@
+"""
+This module contains the live preview of the spectrum export. It shows the
+frame of the current scene frame in an image without writing any files.
+"""
+import bpy
+from bpy.app.handlers import persistent
+
+from . image_helpers import display_pixels
+from . spectrumcore import SpectrumPreview, SpectrumSettings, image_channels
+from . spectrumexport import output_name
+from . spectrumexportproperties import SpectrumExportProperties
+
+# The running preview, None if it is stopped
+_preview = None
+
+# Owner of the message bus subscription
+_OWNER = object()
+
+
+def preview_name(props):
+    """
+    Returns the name of the preview image.
+    """
+    return f"{output_name(props)}_preview"
+
+
+def preview_running():
+    return _preview is not None
+
+
+def preview_frame_id(scene, settings: SpectrumSettings):
+    """
+    Returns the output frame shown at the current scene frame, output frame
+    N lies on scene frame N + 1 like the image sequence.
+    """
+    scene_fps = scene.render.fps/scene.render.fps_base
+    return round((scene.frame_current - 1)*settings.fps/scene_fps)
+
+
+def update_preview(scene, force: bool = False):
+    """
+    Writes the current frame into the preview image. The preview is
+    recreated if the audio file or a setting of the raw spectra changed,
+    for other settings only the post-processing is replaced.
+
+    Args:
+        scene (bpy.types.Scene) The scene with the export properties.
+        force (bool, optional) If false the image is only updated if the
+            preview had to be recreated.
+    """
+    global _preview
+    if _preview is None:
+        return
+    props = scene.spectrum_export_props
+    settings = SpectrumSettings.from_props(props)
+    audiopath = bpy.path.abspath(props.input_sound_name)
+    if _preview.is_current(audiopath, settings):
+        if not force:
+            return
+    else:
+        try:
+            if _preview.shares_source(audiopath, settings):
+                _preview.set_settings(settings)
+            else:
+                old, _preview = _preview, None
+                old.close()
+                _preview = SpectrumPreview(audiopath, settings)
+        except BaseException:
+            stop_preview()
+            raise
+
+    img = _preview.frame(preview_frame_id(scene, settings))
+    height, width = img.shape[:2]
+
+    name = preview_name(props)
+    image = bpy.data.images.get(name)
+    if image is None:
+        image = bpy.data.images.new(name, width, height, alpha=True, float_buffer=True, is_data=True)
+    elif tuple(image.size) != (width, height):
+        image.scale(width, height)
+    if settings.stereo_mode == "LEFT_RIGHT":
+        # Alpha holds data, it must not be premultiplied
+        image.alpha_mode = "CHANNEL_PACKED"
+    image.pixels.foreach_set(display_pixels(img, image_channels(settings)).ravel())
+    image.update()
+
+    for area in bpy.context.screen.areas if bpy.context.screen else ():
+        if area.type == "IMAGE_EDITOR":
+            area.tag_redraw()
+
+
+def _on_frame_change(scene, *args):
+    update_preview(scene, force=True)
+
+
+def _on_props_change():
+    update_preview(bpy.context.scene)
+
+
+@persistent
+def _on_load(*args):
+    # The preview belongs to the file that was open
+    stop_preview()
+
+
+def start_preview(scene):
+    """
+    Starts the preview of the current settings and shows the current frame.
+    """
+    global _preview
+    props = scene.spectrum_export_props
+    settings = SpectrumSettings.from_props(props)
+    _preview = SpectrumPreview(bpy.path.abspath(props.input_sound_name), settings)
+
+    bpy.app.handlers.frame_change_post.append(_on_frame_change)
+    bpy.app.handlers.load_pre.append(_on_load)
+    # Any change of the export properties invalidates the preview
+    bpy.msgbus.subscribe_rna(key=SpectrumExportProperties, owner=_OWNER, args=(), notify=_on_props_change)
+    update_preview(scene, force=True)
+
+
+def stop_preview():
+    """
+    Stops the preview, the preview image is kept.
+    """
+    global _preview
+    if _preview is not None:
+        _preview.close()
+        _preview = None
+    bpy.msgbus.clear_by_owner(_OWNER)
+    for handlers, handler in ((bpy.app.handlers.frame_change_post, _on_frame_change),
+                              (bpy.app.handlers.load_pre, _on_load)):
+        if handler in handlers:
+            handlers.remove(handler)
+
+
+class SpectrumPreviewToggle(bpy.types.Operator):
+    """Show the spectrum of the current frame in an image, without exporting"""
+
+    bl_category = "Audio Tools"
+    bl_idname = "image.toggle_spectrum_preview"
+    bl_label = "Toggle Spectrum Preview"
+
+    def execute(self, context):
+        if preview_running():
+            stop_preview()
+            return {'FINISHED'}
+
+        start_preview(context.scene)
+        image = bpy.data.images[preview_name(context.scene.spectrum_export_props)]
+        if context.area is not None and context.area.type == "IMAGE_EDITOR":
+            context.space_data.image = image
+        return {'FINISHED'}